@@ -0,0 +1,83 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Microbenchmark comparing view code exec'd in a dictionary of locals
+(as Keystone did before view code was compiled into functions) with
+the function RenderEngine.parse() now builds. Run from the top of the
+source tree:
+
+    $ python bench/viewfunc.py
+"""
+
+import os.path
+import sys
+import timeit
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from keystone.render import RenderEngine
+
+VIEW = """
+import math
+rows = []
+total = 0
+for i in range(200):
+    value = math.sqrt(i) * scale
+    if value > threshold:
+        total += value
+        rows.append((i, round(value, 2)))
+average = total / max(len(rows), 1)
+----
+"""
+
+class App(object):
+    app_dir = os.getcwd()
+
+def main():
+    engine = RenderEngine(App())
+    fileobj = StringIO(VIEW)
+    fileobj.name = 'bench.ks'
+    template = engine.parse(fileobj)
+
+    viewcode, viewglobals = engine.compile(VIEW.split('----')[0], 'bench.ks')
+    def exec_viewfunc(viewlocals):
+        exec viewcode in viewglobals, viewlocals
+        return viewlocals
+
+    def viewlocals():
+        return {'request': None, 'http': None, 'headers': None,
+                'scale': 1.5, 'threshold': 3}
+
+    assert exec_viewfunc(viewlocals())['rows'] == template.viewfunc(viewlocals())['rows']
+
+    number = 2000
+    for label, viewfunc in (('exec', exec_viewfunc), ('function', template.viewfunc)):
+        best = min(timeit.repeat(lambda: viewfunc(viewlocals()), number=number, repeat=5))
+        print '%-10s %8.1f usec per view' % (label, best / number * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+
+__all__ = ('CachedPage', 'PageCache', 'SingleFlight', 'DiskMirror')
+
+import gzip
+import hashlib
+import os, os.path
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.wrappers import Response
+
+class CachedPage(object):
+    """A fully-buffered response which can be replayed to later
+    requests for the same URL."""
+
+    def __init__(self, status, headers, body, version, ttl):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.version = version
+        self.ttl = ttl
+        self.created = time.time()
+        self.etag = hashlib.md5(body).hexdigest()
+
+    @classmethod
+    def from_response(cls, response, version, ttl):
+        body = ''.join(response.iter_encoded())
+        headers = [(k, v) for k, v in response.headers if k.lower() != 'content-length']
+        return cls(response.status_code, headers, body, version, ttl)
+
+    def age(self, now=None):
+        return (now or time.time()) - self.created
+
+    def response(self):
+        response = Response(self.body, status=self.status, headers=self.headers)
+        if 'ETag' not in response.headers:
+            response.set_etag(self.etag)
+        return response
+
+class PageCache(object):
+    """Holds rendered pages for templates which opt in to caching.
+
+    Pages younger than their TTL are fresh. For a further
+    `stale_while_revalidate` seconds, an expired page is still
+    served while a single background thread renders a replacement.
+    If rendering fails, an expired page may be served in place of
+    the error until it is `stale_if_error` seconds past its TTL.
+    """
+
+    def __init__(self, stale_while_revalidate=0, stale_if_error=0, max_entries=1000):
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.max_entries = max_entries
+
+        self.pages = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def key(self, request):
+        if request.query_string:
+            return request.path + '?' + request.query_string
+        return request.path
+
+    def get(self, key, version):
+        """Return the cached page for `key`, unless it was rendered
+        from a different version of its template or is too old to
+        be of any further use."""
+        page = self.pages.get(key)
+        if page is None:
+            return None
+
+        usable = max(self.stale_while_revalidate, self.stale_if_error)
+        if page.version != version or page.age() >= page.ttl + usable:
+            self.discard(key, page)
+            return None
+
+        return page
+
+    def put(self, key, page):
+        with self.lock:
+            if key not in self.pages and len(self.pages) >= self.max_entries:
+                self._prune()
+            self.pages[key] = page
+
+    def discard(self, key, page=None):
+        with self.lock:
+            if page is None or self.pages.get(key) is page:
+                self.pages.pop(key, None)
+
+    def _prune(self):
+        # called with self.lock held; drop the oldest tenth
+        # of the entries to make room for new ones
+        oldest = sorted(self.pages, key=lambda k: self.pages[k].created)
+        for key in oldest[:max(1, len(oldest) // 10)]:
+            del self.pages[key]
+
+    def is_fresh(self, page):
+        return page.age() < page.ttl
+
+    def can_revalidate(self, page):
+        return page.age() < page.ttl + self.stale_while_revalidate
+
+    def can_serve_on_error(self, page):
+        return page.age() < page.ttl + self.stale_if_error
+
+    def revalidate(self, key, render):
+        """Call `render` on a background thread, unless one is already
+        running for `key`. `render` is responsible for storing the
+        new page; if it raises, the stale page is left in place.
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                render()
+            except Exception:
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        thread = threading.Thread(target=run, name='keystone-revalidate')
+        thread.daemon = True
+        thread.start()
+
+class SingleFlight(object):
+    """Runs at most one call at a time for any given key. Callers
+    which arrive while a call for their key is in progress wait for
+    it to finish and share its result (or its exception), unless
+    `shareable(result)` is false, in which case they make the call
+    themselves."""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, shareable=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            if shareable is not None and not shareable(call.result):
+                return func()
+            return call.result
+
+        try:
+            call.result = func()
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class DiskMirror(object):
+    """Writes cached pages to a directory tree laid out like the URL
+    space, as "<path>/index.html" plus a gzipped copy alongside,
+    so that a front-end server can serve them without calling
+    Keystone. A background thread removes each file once its TTL
+    passes or any of the templates it was rendered from changes.
+    """
+
+    FILENAMES = ('index.html', 'index.html.gz')
+
+    def __init__(self, root, interval=1):
+        self.root = os.path.abspath(root)
+        self.interval = interval
+
+        # maps mirrored path => (source files => mtimes, expiry time)
+        self.files = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sweeper = None
+
+        # files left behind by an earlier process can't be
+        # expired, since we don't know where they came from
+        self.clear()
+
+    def write(self, path, body, sources, ttl):
+        dirname = os.path.abspath(os.path.join(self.root, path.lstrip('/')))
+        if dirname != self.root and not dirname.startswith(self.root + os.sep):
+            return
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        html, gz = [os.path.join(dirname, name) for name in self.FILENAMES]
+        with self.lock:
+            self.files[html] = self.files[gz] = (sources, time.time() + ttl)
+
+        self._atomic_write(html, body, compress=False)
+        self._atomic_write(gz, body, compress=True)
+
+        if self.sweeper is None:
+            self.sweeper = threading.Thread(target=self._run, name='keystone-mirror')
+            self.sweeper.daemon = True
+            self.sweeper.start()
+
+    def after_fork(self):
+        """Let a forked child start its own sweeper thread when it
+        next writes a page."""
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    def _atomic_write(self, filename, body, compress):
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.mirror')
+        try:
+            fp = os.fdopen(fd, 'wb')
+            if compress:
+                gzfp = gzip.GzipFile(os.path.basename(filename)[:-3], 'wb', 9, fp)
+                gzfp.write(body)
+                gzfp.close()
+            else:
+                fp.write(body)
+            fp.close()
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, filename)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def _run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.interval)
+            self.sweep()
+
+    def sweep(self):
+        """Remove mirrored files which have expired, or whose
+        template has changed or been removed."""
+        now = time.time()
+        with self.lock:
+            files = self.files.items()
+
+        for filename, (sources, expires) in files:
+            if expires > now and self._unchanged(sources):
+                continue
+            self.remove(filename)
+
+    def _unchanged(self, sources):
+        try:
+            for source, mtime in sources.iteritems():
+                if os.stat(source).st_mtime != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def remove(self, filename):
+        with self.lock:
+            self.files.pop(filename, None)
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all mirrored files."""
+        with self.lock:
+            self.files.clear()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename in self.FILENAMES:
+                    self.remove(os.path.join(dirpath, filename))
+
+    def close(self):
+        self.stopped.set()
+        self.clear()
@@ -0,0 +1,116 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('stream_events', 'EventStream', 'format_event')
+
+import Queue
+import threading
+
+from keystone.render import StopViewFunc
+
+# marks the end of the events in an EventStream's queue
+_END = object()
+
+def format_event(event):
+    """Format an event for a text/event-stream response. `event` is
+    either the data, as a string, or a dictionary with "data" and
+    optionally "event", "id" and "retry" keys."""
+    if not isinstance(event, dict):
+        event = {'data': event}
+
+    lines = []
+    for field in ('event', 'id', 'retry'):
+        if event.get(field) is not None:
+            lines.append('%s: %s' % (field, event[field]))
+    for line in unicode(event.get('data', '')).splitlines() or ['']:
+        lines.append('data: %s' % line)
+    return (u'\n'.join(lines) + u'\n\n').encode('utf-8')
+
+class EventStream(object):
+    """A response body which sends the events yielded by `source` as
+    Server-Sent Events.
+
+    A thread runs `source`, so that while it has nothing to send, a
+    comment is sent every `heartbeat` seconds to keep the connection
+    open and to find out if the client has gone away. When it has, the
+    server closes the response, and `source` is closed the next time
+    it yields. Sources which may wait a long time for news can yield
+    None to give it the chance.
+    """
+
+    def __init__(self, source, heartbeat=15, queue_size=100):
+        self.source = source
+        self.heartbeat = heartbeat
+        self.queue = Queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.producer = None
+
+    def __iter__(self):
+        if self.producer is None:
+            self.producer = threading.Thread(target=self.produce, name='keystone-events')
+            self.producer.daemon = True
+            self.producer.start()
+
+        while not self.stopped.isSet():
+            try:
+                event = self.queue.get(timeout=self.heartbeat)
+            except Queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            if event is _END:
+                break
+            yield format_event(event)
+
+    def produce(self):
+        try:
+            for event in self.source:
+                if self.stopped.isSet():
+                    break
+                if event is None:
+                    continue
+                while not self.stopped.isSet():
+                    try:
+                        self.queue.put(event, timeout=1)
+                        break
+                    except Queue.Full:
+                        pass
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+            try:
+                self.queue.put(_END, timeout=1)
+            except Queue.Full:
+                pass
+
+    def close(self):
+        """Called by the WSGI server when the response is finished,
+        or the client has disconnected."""
+        self.stopped.set()
+
+def stream_events(source, heartbeat=15):
+    """Passed into viewlocals to respond with a stream of Server-Sent
+    Events, one for each item yielded by `source`.
+    """
+    raise StopViewFunc(EventStream(source, heartbeat))
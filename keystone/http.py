@@ -35,10 +35,11 @@ __all__ = (
 
     # from Keystone
     'MovedPermanently', 'Found', 'SeeOther', 'NotModified', 'UseProxy',
-    'TemporaryRedirect')
+    'TemporaryRedirect', 'GatewayTimeout')
 
 from werkzeug.exceptions import *
 from werkzeug.datastructures import Headers
+from werkzeug.http import quote_etag
 from werkzeug.utils import redirect
 
 class ThreeOhX(HTTPException):
@@ -82,10 +83,32 @@ class NotModified(HTTPException):
     """`304 Not Modified`
 
     Sent in response to a conditional GET request when the user agent's
-    cached copy is already up to date.
+    cached copy is already up to date. Of `headers`, the ones which
+    describe how to cache the page are sent along with the ETag.
     """
     code = 304
     description = None
+    passthrough_headers = ('Cache-Control', 'Content-Location', 'Expires', 'Vary', 'Set-Cookie')
+
+    def __init__(self, etag=None, headers=()):
+        HTTPException.__init__(self)
+        self.etag = etag
+        self.headers = [(key, value) for key, value in headers
+                        if key.title() in self.passthrough_headers]
+
+    def get_headers(self, environ):
+        headers = Headers(self.headers)
+        if self.etag is not None:
+            headers['ETag'] = quote_etag(self.etag)
+        return headers
+
+    def get_body(self, environ):
+        return ''
+
+    def get_response(self, environ):
+        response = HTTPException.get_response(self, environ)
+        del response.headers['Content-Type']
+        return response
 
 class UseProxy(ThreeOhX):
     """`305 Use Proxy`
@@ -107,3 +130,13 @@ class TemporaryRedirect(ThreeOhX):
     code = 307
     description = 'Temporary Redirect'
 
+class GatewayTimeout(HTTPException):
+    """`504 Gateway Timeout`
+
+    Raise if a backend the view depends on did not answer in time.
+    """
+    code = 504
+    description = (
+        '<p>The server did not receive a timely response from a service '
+        'it needed to complete your request.</p>'
+    )
@@ -23,20 +23,30 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+from __future__ import with_statement
 
 from datetime import datetime
-from itertools import izip
+from itertools import chain, izip
+import gc
 import hashlib
+import imp
 import mimetypes
 import os, os.path
+import stat
 import sys
+import time
 import urlparse
 import warnings
 
 from werkzeug.wrappers import Request, Response
 from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
+from werkzeug.wsgi import wrap_file
 
 from keystone import http
+from keystone.cache import CachedPage, PageCache, SingleFlight, DiskMirror
+from keystone.events import EventStream, stream_events
+from keystone.pool import ThreadPool, ProcessPool, Timeout
 from keystone.render import *
 
 # requests for paths ending in these extensions
@@ -44,20 +54,117 @@ from keystone.render import *
 HIDDEN_EXTS = set(('.ks', '.py', '.pyc', '.pyo'))
 HIDDEN_PREFIXES = set(('.', '_'))
 
+# files are read in blocks of this size, whatever chunk_size is
+FILE_BLOCK_SIZE = 65536
+
+def _regular_file_size(fileobj):
+    """Return the size of `fileobj` if it is a regular file whose
+    position can be read and set, or None."""
+    try:
+        st = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        fileobj.seek(fileobj.tell())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return st.st_size
+
+def _shareable(page):
+    """Cookies may identify the user the page was rendered for, so
+    pages which set them are not shared with coalesced requests."""
+    return not any(k.lower() == 'set-cookie' for k, v in page.headers)
+
+def _run_task(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception, e:
+        warnings.warn('after_response task %r failed: %s' % (func, e))
+
 class Keystone(object):
 
-    def __init__(self, app_dir=os.getcwd(), static_expires=86400):
+    def __init__(self, app_dir=os.getcwd(), static_expires=86400,
+                 stale_while_revalidate=0, stale_if_error=0, mirror_dir=None,
+                 auto_etag=False, chunk_size=16384, buffer_size=65536,
+                 bytecode_cache=None, warm_up=False, warm_up_processes=None,
+                 template_cache_size=1000, template_cache_bytes=None,
+                 pinned_templates=(), thread_pool=None, defer_timeout=30,
+                 process_pool=None, offload_timeout=None, check_interval=0,
+                 render_once=True, minify=False, after_response_pool=None):
         self.app_dir = os.path.abspath(app_dir)
         self.static_expires = 86400
-        self.engine = RenderEngine(self)
+        self.auto_etag = auto_etag
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.render_once = render_once
+        # maps template name => CachedPage, for static templates
+        self.static_pages = {}
+        self.engine = RenderEngine(self, bytecode_cache, TemplateCache(
+            template_cache_size, template_cache_bytes, pinned_templates), check_interval, minify)
+        self.cache = PageCache(stale_while_revalidate, stale_if_error)
+        self.flights = SingleFlight()
+        self.defer_timeout = defer_timeout
+        self.own_pool = thread_pool is None
+        self.pool = ThreadPool() if thread_pool is None else thread_pool
+        self.offload_timeout = offload_timeout
+        self.own_after_pool = after_response_pool is None
+        self.after_pool = after_response_pool
+        if after_response_pool is None:
+            self.after_pool = ThreadPool(4, max_queue=1000)
+        self.own_process_pool = process_pool is None
+        self.process_pool = process_pool
+        self.mirror = None
+        if mirror_dir is not None:
+            self.mirror = DiskMirror(mirror_dir)
 
         if self.app_dir not in sys.path:
             sys.path.insert(0, self.app_dir)
 
-        try:
-            import startup
-        except ImportError:
-            pass
+        # load startup.py by path, rather than importing it, so that
+        # each application in a process gets its own startup.py
+        startup = os.path.join(self.app_dir, 'startup.py')
+        modules = {}
+        if os.path.isfile(startup):
+            sys.modules.pop('startup', None)
+            with self.engine.starting():
+                modules['startup'] = imp.load_source('startup', startup)
+            self.engine.import_filters(modules['startup'])
+
+        # the pool's workers use this application's startup.py, even
+        # when another application has loaded its own since
+        if process_pool is None:
+            self.process_pool = ProcessPool(modules=modules)
+
+        if warm_up:
+            self.engine.warm_up(warm_up_processes)
+
+            # keep the warmed-up objects out of future collections, so
+            # that forked worker processes continue to share their
+            # memory pages rather than copying them (Python 3.7+)
+            gc.collect()
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+
+    def close(self):
+        """Stop background threads and processes, and remove
+        mirrored pages. Waits for queued after_response() calls."""
+        if self.mirror is not None:
+            self.mirror.close()
+        if self.own_pool:
+            self.pool.close()
+        if self.own_process_pool:
+            self.process_pool.close()
+        self.engine.providers.close()
+        if self.own_after_pool:
+            self.after_pool.close(wait=True)
+
+    def after_fork(self):
+        """Restart background threads in a process forked from the one
+        which created the application, such as a server's worker."""
+        for pool in (self.pool, self.process_pool, self.after_pool):
+            pool.after_fork()
+        self.engine.providers.after_fork()
+        if self.mirror is not None:
+            self.mirror.after_fork()
 
     def __call__(self, environ, start_response):
         request = Request(environ)
@@ -69,7 +176,21 @@ class Keystone(object):
             found = self._find(request.path)
 
             if isinstance(found, Template):
-                return self.render_keystone(request, found)
+                if request.method not in ('GET', 'HEAD'):
+                    return self.render_keystone(request, found)
+
+                if self.render_once and self.engine.is_static(found.name):
+                    response = self.render_once_page(request, found)
+                elif found.options.get('cache'):
+                    response = self.render_cached(request, found)
+                elif found.options.get('coalesce'):
+                    response = self.render_coalesced(request, found)
+                else:
+                    response = self.render_keystone(request, found)
+
+                if self.auto_etag:
+                    return self.make_conditional(request, response)
+                return response
             elif isinstance(found, file):
                 return self.render_static(request, found)
 
@@ -82,18 +203,68 @@ class Keystone(object):
     def render_keystone(self, request, template):
         response = Response(mimetype='text/html')
 
-        viewlocals = {
+        tasks = []
+        def after_response(func, *args, **kwargs):
+            tasks.append((func, args, kwargs))
+
+        viewlocals = dict(self.engine.providers.values)
+        viewlocals.update({
             'request': request,
             'http': http,
             'headers': response.headers,
             'set_cookie': response.set_cookie,
             'delete_cookie': response.delete_cookie,
             'return_response': return_response,
+            'return_file': return_file,
+            'stream_events': stream_events,
+            'lazy': lazy,
+            'defer': self.defer,
+            'parallel': self.parallel,
+            'offload': self.offload,
+            'after_response': after_response,
             'app_dir': self.app_dir,
-        }
+        })
+
+        response = self.render_view(request, response, template, viewlocals)
+        if tasks:
+            response.call_on_close(lambda: self.run_after_response(tasks))
+        return response
 
+    def render_view(self, request, response, template, viewlocals):
+        """Run the template's view code and render it into `response`,
+        or return the response for an HTTPException it raises."""
+        default_type = response.headers['Content-Type']
         try:
-            response.response = self.engine.render(template, viewlocals)
+            body = self.engine.render(template, viewlocals)
+            if isinstance(body, FileBody) or hasattr(body, 'read'):
+                if not isinstance(body, FileBody):
+                    body = FileBody(body)
+                if body.mimetype and response.headers['Content-Type'] == default_type:
+                    response.mimetype = body.mimetype
+                return self.file_response(request, response, body)
+            if isinstance(body, EventStream):
+                return self.event_response(response, body)
+
+            body = coalesce(body, self.chunk_size, response.charset)
+
+            # render up to buffer_size bytes before responding; if
+            # that is the whole body, we can send a Content-Length.
+            # an empty chunk means the template used {% flush %}.
+            buffered, length = [], 0
+            for chunk in body:
+                if not chunk:
+                    body = chain(buffered, body)
+                    break
+                buffered.append(chunk)
+                length += len(chunk)
+                if length > self.buffer_size:
+                    body = chain(buffered, body)
+                    break
+            else:
+                body = buffered
+                response.content_length = length
+
+            response.response = body
         except HTTPException, ex:
             return ex.get_response(request.environ)
         except:
@@ -101,6 +272,219 @@ class Keystone(object):
 
         return response
 
+    def file_response(self, request, response, body):
+        """Send a FileBody as the body of `response`. If it is a
+        regular file, the response has a Content-Length, and if the body
+        runs to the end of the file, it is handed to the server's
+        wsgi.file_wrapper, which may send it with sendfile(). Pipes,
+        sockets and other streams are read in chunks until they end.
+        """
+        fileobj = body.fileobj
+        size = _regular_file_size(fileobj)
+        if size is None:
+            response.response = body.read_range(body.length, FILE_BLOCK_SIZE, body.offset or 0)
+            response.direct_passthrough = True
+            return response
+
+        offset = body.offset
+        if offset is None:
+            offset = fileobj.tell()
+        else:
+            fileobj.seek(offset)
+
+        length = body.length
+        available = max(0, size - offset)
+        length = available if length is None else min(length, available)
+        response.content_length = length
+
+        if body.length is None or offset + length == size:
+            response.response = wrap_file(request.environ, fileobj, FILE_BLOCK_SIZE)
+        else:
+            response.response = body.read_range(length, FILE_BLOCK_SIZE)
+        response.direct_passthrough = True
+        return response
+
+    def event_response(self, response, body):
+        """Send an EventStream as the body of `response`, with headers
+        asking browsers, proxies and front-end servers not to cache or
+        buffer it."""
+        response.mimetype = 'text/event-stream'
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.response = body
+        response.direct_passthrough = True
+        return response
+
+    def run_after_response(self, tasks):
+        """Queue the calls which a view passed to after_response() in
+        the after-response pool, once its response has been sent."""
+        for func, args, kwargs in tasks:
+            try:
+                self.after_pool.submit(_run_task, func, args, kwargs)
+            except RuntimeError:
+                # the application is shutting down
+                return
+
+    def defer(self, func, *args, **kwargs):
+        """Passed into viewlocals to start func(*args, **kwargs) in
+        the application's thread pool, returning a proxy for its
+        result which waits for it when first used. If the call
+        raised an exception, using the result raises it; if it
+        takes longer than defer_timeout seconds from the time it
+        was deferred, using the result raises GatewayTimeout.
+        """
+        future = self.pool.submit(func, *args, **kwargs)
+        deadline = None
+        if self.defer_timeout is not None:
+            deadline = time.time() + self.defer_timeout
+
+        def resolve():
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            try:
+                return future.result(timeout)
+            except Timeout:
+                raise http.GatewayTimeout()
+        return LocalProxy(resolve)
+
+    def parallel(self, *funcs):
+        """Passed into viewlocals to defer() several calls at once,
+        returning a list of their results in the same order."""
+        return [self.defer(func) for func in funcs]
+
+    def offload(self, func, *args, **kwargs):
+        """Passed into viewlocals to run CPU-bound work in the
+        application's process pool, so that it doesn't hold the GIL
+        while other requests are served, and return its result. If
+        the call takes longer than offload_timeout seconds, raises
+        GatewayTimeout.
+        """
+        try:
+            return self.process_pool.run(func, args, kwargs, self.offload_timeout)
+        except Timeout:
+            raise http.GatewayTimeout()
+
+    def render_once_page(self, request, template):
+        """Serve a template which renders the same page on every
+        request from a copy rendered once per version of its files."""
+        version = self.engine.version(template.name)
+        page = self.static_pages.get(template.name)
+        if page is None or page.version != version:
+            response = self.render_keystone(request, template)
+            if response.status_code != 200:
+                return response
+            try:
+                page = CachedPage.from_response(response, version, None)
+            except:
+                raise http.InternalServerError()
+            self.static_pages[template.name] = page
+        return page.response()
+
+    def render_cached(self, request, template):
+        """Serve a template which sets "__cache__" from the page
+        cache, rendering it if no usable page is cached. Expired
+        pages may be served while they are re-rendered, or in place
+        of an error, according to the cache's stale windows.
+        """
+        key = self.cache.key(request)
+        page = self.cache.get(key, self.engine.version(template.name))
+
+        if page is not None:
+            if self.cache.is_fresh(page):
+                return page.response()
+
+            if self.cache.can_revalidate(page):
+                environ = dict(request.environ)
+                self.cache.revalidate(key, lambda: self._render_page(key, Request(environ), template))
+                return page.response()
+
+        try:
+            fresh = self._render_page(key, request, template)
+        except http.InternalServerError:
+            fresh = None
+
+        if fresh is None or fresh.status >= 500:
+            if page is not None and self.cache.can_serve_on_error(page):
+                return page.response()
+            if fresh is None:
+                raise http.InternalServerError()
+
+        return fresh.response()
+
+    def render_coalesced(self, request, template):
+        """Serve a template which sets "__coalesce__", sharing one
+        rendering of the page among all concurrent requests for it.
+        """
+        key = self.cache.key(request)
+        return self._render_page(key, request, template).response()
+
+    def _render_page(self, key, request, template):
+        """Render and buffer the response for `template`, storing it in
+        the page cache if the template is cacheable and the response
+        is successful and does not set cookies; such HTML pages are
+        also written to the mirror directory, if one is configured,
+        when they were requested without a query string. If the
+        template sets "__coalesce__", concurrent calls for the same
+        key wait for and share the result of the first, unless it sets
+        cookies, in which case they render the page themselves. Raises
+        InternalServerError if rendering fails.
+        """
+        def render():
+            response = self.render_keystone(request, template)
+            if isinstance(response.response, EventStream):
+                # never ends, so can't be buffered or shared
+                response.response.close()
+                warnings.warn('%s streams events, and cannot use __cache__ or __coalesce__' % template.name)
+                raise http.InternalServerError()
+            try:
+                version = self.engine.version(template.name)
+                page = CachedPage.from_response(response, version, template.options.get('cache'))
+            except:
+                raise http.InternalServerError()
+            # the response itself is never sent, so finish it here
+            response.close()
+
+            if page.ttl and page.status == 200 and 'Set-Cookie' not in response.headers:
+                self.cache.put(key, page)
+                if self.mirror is not None and response.mimetype == 'text/html' and not request.query_string:
+                    sources = dict((os.path.join(self.app_dir, t.name), t.mtime)
+                                   for t in self.engine.closure(template.name))
+                    self.mirror.write(request.path, page.body, sources, page.ttl)
+            return page
+
+        if template.options.get('coalesce'):
+            return self.flights.do(key, render, _shareable)
+        return render()
+
+    def make_conditional(self, request, response):
+        """Give a successful response a strong ETag, buffering its body
+        to compute one if it has none yet, and raise NotModified if the
+        request's If-None-Match header matches it. File responses
+        without an ETag are sent as they are.
+        """
+        if response.status_code != 200:
+            return response
+
+        etag, weak = response.get_etag()
+        if etag is None or weak:
+            if response.direct_passthrough:
+                return response
+            try:
+                body = ''.join(response.iter_encoded())
+            except:
+                raise http.InternalServerError()
+            response.response = [body]
+            response.content_length = len(body)
+
+            etag = hashlib.md5(body).hexdigest()
+            response.set_etag(etag)
+
+        if request.if_none_match.contains(etag):
+            response.close()
+            raise http.NotModified(etag, response.headers)
+        return response
+
     def render_static(self, request, fileobj):
         if request.method != 'GET':
             raise http.MethodNotAllowed(['GET'])
@@ -144,9 +528,10 @@ class Keystone(object):
 
         # next: see if an exact path match with
         # extension ".ks" exists, and load template
-        fspath += '.ks'
-        if os.path.isfile(fspath):
+        try:
             return self.engine.get_template(path + '.ks')
+        except TemplateNotFound:
+            pass
 
         # finally: see if a parameterized path matches
         # the request path.
@@ -0,0 +1,248 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import with_statement
+
+__all__ = ('ThreadPool', 'ProcessPool', 'Future', 'Timeout', 'OffloadError')
+
+import cPickle as pickle
+import multiprocessing
+import Queue
+import sys
+import threading
+import traceback
+
+class Timeout(Exception):
+    """Raised by Future.result() when the call has not finished
+    within the timeout."""
+
+class OffloadError(Exception):
+    """Raised in place of the result of, or an exception raised by,
+    a call in a ProcessPool which could not be pickled to send it
+    back from the worker process."""
+
+class Future(object):
+    """The eventual result of a call submitted to a ThreadPool."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def run(self, func, args, kwargs):
+        try:
+            self.value = func(*args, **kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+        self.event.set()
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        """Wait up to `timeout` seconds (or forever) for the call to
+        finish, and return its result or re-raise its exception."""
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise Timeout()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class ThreadPool(object):
+    """Runs submitted calls in at most `size` daemon threads, which
+    are started as they are needed. Calls submitted while every
+    thread is busy wait their turn, in a queue of at most `max_queue`
+    calls (by default, unlimited). When the queue is full, submit()
+    waits for room if `full` is "block", or drops the call if it is
+    "drop"."""
+
+    def __init__(self, size=16, max_queue=0, full='block'):
+        if full not in ('block', 'drop'):
+            raise ValueError('full must be "block" or "drop"')
+        self.size = size
+        self.full = full
+        self.queue = Queue.Queue(max_queue)
+        self.threads = []
+        self.pending = 0
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in a pool thread, and return a
+        Future for its result, or None if the call was dropped."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('thread pool is closed')
+            self.pending += 1
+            if self.pending > len(self.threads) and len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        job = (future, func, args, kwargs)
+        if self.full == 'drop':
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                with self.lock:
+                    self.pending -= 1
+                    self.dropped += 1
+                return None
+        else:
+            self.queue.put(job)
+        return future
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            future.run(func, args, kwargs)
+            with self.lock:
+                self.pending -= 1
+
+    def after_fork(self):
+        """Forget the threads of the parent process, which don't run in
+        a forked child, along with the calls queued for them."""
+        self.queue = Queue.Queue(self.queue.maxsize)
+        self.threads = []
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def close(self, wait=False):
+        """Stop the threads once the calls already submitted have
+        finished, waiting for them if `wait` is True."""
+        with self.lock:
+            self.closed = True
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+class _FunctionRef(object):
+    """Names a function in one of a ProcessPool's `modules`, which
+    may not be the module of that name in sys.modules."""
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def resolve(self):
+        return getattr(sys.modules[self.module], self.name)
+
+def _install_modules(modules):
+    """Initialize a ProcessPool's worker process."""
+    sys.modules.update(modules)
+
+def _run_pickled(payload):
+    """Run a call pickled by ProcessPool.run() in a worker process,
+    and return its pickled outcome."""
+    func, args, kwargs = pickle.loads(payload)
+    if isinstance(func, _FunctionRef):
+        func = func.resolve()
+    try:
+        outcome = (True, func(*args, **kwargs), None)
+    except Exception, e:
+        outcome = (False, e, traceback.format_exc())
+
+    try:
+        data = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+        # an exception which pickles but can't be unpickled would
+        # otherwise break the pool in the parent process
+        pickle.loads(data)
+    except Exception:
+        if outcome[0]:
+            error = OffloadError('the result of %r could not be pickled' % func)
+        else:
+            error = OffloadError('%r could not be pickled, traceback was:\n%s' % (outcome[1], outcome[2]))
+        data = pickle.dumps((False, error, outcome[2]), pickle.HIGHEST_PROTOCOL)
+    return data
+
+class ProcessPool(object):
+    """Runs calls in a pool of `processes` worker processes (by
+    default, one per CPU), which is started when it is first used.
+    Calls, their arguments and their results must be picklable.
+
+    `modules` maps module names to modules which replace those in
+    sys.modules in the worker processes, and in which functions passed
+    to run() are looked up by name; Keystone uses it to send each
+    application's own "startup" module.
+    """
+
+    def __init__(self, processes=None, modules=None):
+        self.processes = processes
+        self.modules = dict(modules or {})
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def run(self, func, args=(), kwargs=None, timeout=None):
+        """Call func(*args, **kwargs) in a worker process and return
+        its result, or raise its exception (with the worker's
+        formatted traceback as its `remote_traceback`). Raises
+        Timeout if it has not finished after `timeout` seconds,
+        though the worker carries on with the call regardless."""
+        module = self.modules.get(getattr(func, '__module__', None))
+        name = getattr(func, '__name__', None)
+        if module is not None and getattr(module, name, None) is func:
+            func = _FunctionRef(func.__module__, name)
+
+        payload = pickle.dumps((func, args, kwargs or {}), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes, _install_modules, (self.modules, ))
+            pool = self.pool
+
+        pending = pool.apply_async(_run_pickled, (payload, ))
+        try:
+            data = pending.get(timeout)
+        except multiprocessing.TimeoutError:
+            raise Timeout()
+
+        ok, value, remote_traceback = pickle.loads(data)
+        if ok:
+            return value
+        value.remote_traceback = remote_traceback
+        raise value
+
+    def after_fork(self):
+        """Forget the parent process's workers; a forked child starts
+        its own when it is first used."""
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        """Stop the worker processes, abandoning any unfinished calls."""
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
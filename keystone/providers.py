@@ -0,0 +1,102 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import with_statement
+
+__all__ = ('ContextProviders', )
+
+import threading
+import time
+import warnings
+
+class _Provider(object):
+    """A function registered with context_provider()."""
+
+    def __init__(self, func, refresh, name):
+        self.func = func
+        self.refresh = refresh
+        self.name = name
+        self.updated = 0
+
+class ContextProviders(object):
+    """Holds the values of an application's context providers, which
+    a background thread recomputes every `refresh` seconds. `values`
+    is a dictionary which is replaced, never changed, so readers need
+    no lock."""
+
+    def __init__(self):
+        self.providers = []
+        self.values = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def register(self, func, refresh, name):
+        """Add a provider, computing its first value immediately, so
+        that errors surface when the application starts."""
+        provider = _Provider(func, refresh, name)
+        self.update(provider)
+        with self.lock:
+            self.providers.append(provider)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='keystone-context')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def update(self, provider):
+        value = provider.func()
+        provider.updated = time.time()
+        with self.lock:
+            values = dict(self.values)
+            values[provider.name] = value
+            self.values = values
+
+    def run(self):
+        while not self.stopped.isSet():
+            now = time.time()
+            with self.lock:
+                providers = list(self.providers)
+            for provider in providers:
+                if now - provider.updated >= provider.refresh:
+                    try:
+                        self.update(provider)
+                    except Exception, e:
+                        # keep serving the last value
+                        provider.updated = now
+                        warnings.warn('context provider %s failed: %s' % (provider.name, e))
+            due = min(p.updated + p.refresh for p in providers)
+            self.stopped.wait(max(0.01, due - time.time()))
+
+    def after_fork(self):
+        """Start the background thread again in a forked child."""
+        self.lock = threading.Lock()
+        self.thread = None
+        if self.providers:
+            self.thread = threading.Thread(target=self.run, name='keystone-context')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def close(self):
+        self.stopped.set()
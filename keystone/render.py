@@ -23,14 +23,53 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+from __future__ import with_statement
 
-__all__ = ('return_response', 'template_filter', 'Template',
-           'RenderEngine', 'InvalidTemplate')
+__all__ = ('return_response', 'return_file', 'FileBody', 'lazy', 'template_filter',
+           'context_provider', 'coalesce',
+           'Template', 'RenderEngine', 'TemplateCache', 'MemoryBytecodeCache',
+           'InvalidTemplate', 'TemplateNotFound')
 
+import ast
+import collections
 import compiler
-from compiler.ast import Import, From
+import contextlib
+import functools
+import inspect
+import itertools
+from compiler.ast import Import, From, Assign, AssName, Const, Name
 import jinja2
+import jinja2.ext
+import jinja2.meta
+import jinja2.utils
+import marshal
+import mimetypes
+import multiprocessing
 import os, os.path
+import re
+import stat
+import sys
+import threading
+import time
+import types
+import warnings
+from werkzeug.local import LocalProxy
+
+from keystone.providers import ContextProviders
+
+# top-level assignments to these names in view code are read
+# when the template is parsed, and configure how Keystone
+# serves the template (rather than being template variables)
+DIRECTIVES = {
+    '__cache__': 'cache',
+    '__coalesce__': 'coalesce',
+}
+
+# view code matching this may assign to its globals
+_GLOBALS_RE = re.compile(r'\bglobal')
+
+# emitted by {% flush %} in template output, and removed by coalesce()
+FLUSH = u'\ufdd0flush\ufdd0'
 
 class InvalidTemplate(Exception):
     """Indicates that a .ks template has more than one separator."""
@@ -52,38 +91,708 @@ def return_response(body):
         body = (body, )
     raise StopViewFunc(body)
 
-def template_filter(func):
+class FileBody(object):
+    """A response body of `length` bytes (or up to the end) of a file,
+    starting at `offset` (or the file's current position)."""
+
+    def __init__(self, fileobj, offset=None, length=None, mimetype=None):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.length = length
+        self.mimetype = mimetype
+
+    def read_range(self, length=None, chunk_size=65536, skip=0):
+        """Yield `length` bytes (or up to the end) from the current
+        position, after reading past `skip` bytes, then close the
+        file."""
+        try:
+            while skip > 0:
+                chunk = self.fileobj.read(min(skip, chunk_size))
+                if not chunk:
+                    return
+                skip -= len(chunk)
+            while length is None or length > 0:
+                if length is None:
+                    chunk = self.fileobj.read(chunk_size)
+                else:
+                    chunk = self.fileobj.read(min(length, chunk_size))
+                if not chunk:
+                    break
+                if length is not None:
+                    length -= len(chunk)
+                yield chunk
+        finally:
+            self.fileobj.close()
+
+def return_file(path, offset=0, length=None):
+    """Passed into viewlocals to respond with the contents of the file
+    at `path`, or `length` bytes of it from `offset`, which the WSGI
+    server may be able to send without copying it through Python.
+    """
+    mimetype, encoding = mimetypes.guess_type(path)
+    raise StopViewFunc(FileBody(file(path, 'rb'), offset, length, mimetype))
+
+def lazy(func, *args, **kwargs):
+    """Passed into viewlocals to let view code put off calling `func`
+    until the template first uses its result, for instance after a
+    {% flush %} has sent the top of the page to the browser.
+    """
+    result = []
+    def resolve():
+        if not result:
+            result.append(func(*args, **kwargs))
+        return result[0]
+    return LocalProxy(resolve)
+
+# tracks the engine whose application is starting up in each thread
+_starting = threading.local()
+
+# maps module name => {filter name: function} for the filters each
+# module registered, so that applications which import a module after
+# another application has loaded it can register them too
+_module_filters = {}
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+def _memoize(func, size, ttl=None):
+    """Wrap `func` to keep up to `size` of its results, keyed on the
+    arguments (and their types), for `ttl` seconds or until they are
+    the least recently used. The wrapper has cache_info() and
+    cache_clear() methods, like functools.lru_cache."""
+    results = jinja2.utils.LRUCache(size)
+    stats = [0, 0]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            key = tuple((type(arg), arg) for arg in args)
+            if kwargs:
+                key += (frozenset((k, type(v), v) for k, v in kwargs.iteritems()), )
+            expires, value = results[key]
+            if expires is None or expires > time.time():
+                stats[0] += 1
+                return value
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments
+            stats[1] += 1
+            return func(*args, **kwargs)
+
+        stats[1] += 1
+        value = func(*args, **kwargs)
+        results[key] = (time.time() + ttl if ttl else None, value)
+        return value
+
+    wrapper.cache_info = lambda: CacheInfo(stats[0], stats[1], size, len(results))
+    wrapper.cache_clear = results.clear
+    return wrapper
+
+def template_filter(func=None, cache=None, ttl=None):
     """Register a Jinja2 filter function. The name of the function
     will become the name of the filter in the template environment.
+
+    Used as @template_filter(cache=N, ttl=S), the filter remembers
+    its results for up to N different arguments, for S seconds each
+    (by default, until they are the least recently used).
     """
+    if func is None:
+        return lambda func: template_filter(func, cache, ttl)
+    if cache:
+        func = _memoize(func, cache, ttl)
+
     # by the time this is called (from within Python modules in the
     # application, the RenderEngine, and thus the Jinja Environment,
     # have already been created
-    jinja_env.filters[func.__name__] = func
+    engine = getattr(_starting, 'engine', None)
+    env = engine.jinja_env if engine is not None else jinja_env
+    env.filters[func.__name__] = func
+    if engine is not None:
+        engine.own_filters.add(func.__name__)
+    _module_filters.setdefault(func.__module__, {})[func.__name__] = func
     return func
 
+def context_provider(func=None, refresh=60, name=None):
+    """Register a function, in startup.py, whose result is passed to
+    every view as the view variable `name` (by default, the name of
+    the function). The function is called in the background every
+    `refresh` seconds, rather than during requests.
+    """
+    if func is None:
+        return lambda func: context_provider(func, refresh, name)
+
+    engine = getattr(_starting, 'engine', None)
+    if engine is None:
+        raise RuntimeError('context providers must be registered in startup.py')
+    engine.providers.register(func, refresh, name or func.__name__)
+    return func
+
+def coalesce(chunks, size, encoding='utf-8'):
+    """Join the strings yielded by `chunks`, which are typically many
+    small unicode strings from a template, into encoded chunks of at
+    least `size` bytes each (except for the last), so that the WSGI
+    server writes fewer, larger blocks.
+
+    Where the template used {% flush %}, the output so far is yielded
+    immediately, followed by an empty string to mark the flush.
+    """
+    buffered, length = [], 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            if FLUSH in chunk:
+                parts = chunk.split(FLUSH)
+                for part in parts[:-1]:
+                    buffered.append(part.encode(encoding))
+                    flushed = ''.join(buffered)
+                    if flushed:
+                        yield flushed
+                    yield ''
+                    buffered, length = [], 0
+                chunk = parts[-1]
+            chunk = chunk.encode(encoding)
+
+        buffered.append(chunk)
+        length += len(chunk)
+        if length and length >= size:
+            yield ''.join(buffered)
+            buffered, length = [], 0
+
+    if buffered:
+        yield ''.join(buffered)
+
+# parts of a template which minify() leaves alone (or removes)
+_MINIFY_RE = re.compile(r"""
+    (?P<keep>
+        \{%-?\s*raw\s*-?%\}.*?\{%-?\s*endraw\s*-?%\}
+      | <(?P<tag>pre|textarea|script|style)\b.*?</(?P=tag)\s*>
+      | \{\{.*?\}\} | \{%.*?%\} | \{\#.*?\#\}
+      | <!--\[if.*?-->
+    )
+  | (?P<comment><!--.*?-->)
+  | (?P<space>\s+)
+""", re.S | re.I | re.X)
+
+def minify(source):
+    """Collapse each run of whitespace in an HTML template to a single
+    space (or newline, if it contained one), and remove HTML comments,
+    except within Jinja tags and raw blocks, conditional comments, and
+    <pre>, <textarea>, <script> and <style> elements."""
+    def replace(match):
+        if match.group('keep'):
+            return match.group('keep')
+        if match.group('comment'):
+            return ''
+        return '\n' if '\n' in match.group('space') else ' '
+    return _MINIFY_RE.sub(replace, source)
+
+class MinifyExtension(jinja2.ext.Extension):
+    """Minifies templates before Jinja compiles them."""
+
+    def preprocess(self, source, name, filename=None):
+        return minify(source)
+
+class FlushExtension(jinja2.ext.Extension):
+    """Adds a {% flush %} tag, which sends everything the template has
+    rendered so far to the client before rendering the rest."""
+
+    tags = set(['flush'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # the output of these is captured, and may be changed (by a
+        # filter, say) before it is sent, which would mangle the marker
+        for tag in ('filter', 'call', 'macro'):
+            if tag in parser._tag_stack:
+                parser.fail('{%% flush %%} cannot be used inside {%% %s %%}' % tag, lineno)
+        return jinja2.nodes.Output([jinja2.nodes.Const(FLUSH)], lineno=lineno)
+
+def _sections(fileobj):
+    """Split a .ks file into its view code and template body. The
+    view code is None if the file has no separator ("----")."""
+    first, second = [], []
+    active = first
+
+    for lineno, line in enumerate(fileobj):
+        if line.strip() == '----':
+            if active is second:
+                raise InvalidTemplate(
+                    'Line %d: separator already seen on line %d' % (lineno, len(first)))
+            active = second
+        else:
+            active.append(line)
+
+    if active is first:
+        return None, ''.join(first)
+    return ''.join(first), ''.join(second)
+
+def _no_view(viewlocals):
+    """The viewfunc of templates without view code."""
+    return viewlocals
+
+def _intern(name):
+    return intern(name) if type(name) is str else name
+
 class Template(object):
-    """Holds a template body, viewfunc, mtime, and valid methods."""
+    """Holds a template body, viewfunc, mtime, valid methods, any
+    directives found in the view code, and the names of the templates
+    which the body extends, includes or imports. `dynamic` is True if
+    the body also refers to templates by names computed at runtime,
+    and `uses_context` if it uses variables other than Jinja's globals.
 
-    def __init__(self, viewfunc, body, mtime=None, name=None):
+    Once Jinja has compiled the body, the engine may release() it to
+    save memory; it is then read again from the `source` file if it
+    is needed.
+    """
+
+    __slots__ = ('viewfunc', '_body', 'mtime', 'name', 'options', 'dependencies',
+                 'dynamic', 'uses_context', 'source', 'urlparams')
+
+    def __init__(self, viewfunc, body, mtime=None, name=None, options=None,
+                 dependencies=(), dynamic=False, uses_context=True, source=None):
         self.viewfunc = viewfunc
-        self.body = body
+        self._body = body
         self.mtime = mtime
         self.name = name
+        self.options = options or {}
+        self.dependencies = dependencies
+        self.dynamic = dynamic
+        self.uses_context = uses_context
+        self.source = source
         self.urlparams = {}
 
+    def _get_body(self):
+        if self._body is None:
+            fileobj = file(self.source, 'rb')
+            try:
+                return _sections(fileobj)[1]
+            finally:
+                fileobj.close()
+        return self._body
+
+    def _set_body(self, body):
+        self._body = body
+
+    body = property(_get_body, _set_body)
+
+    def release(self):
+        """Drop the body if it can be read again from the source file."""
+        if self.source is not None:
+            self._body = None
+
     def copy(self):
-        return Template(self.viewfunc, self.body, self.mtime, self.name)
+        return Template(self.viewfunc, self._body, self.mtime, self.name, self.options,
+                        self.dependencies, self.dynamic, self.uses_context, self.source)
+
+class _Unbound(object):
+    """Default value for view function arguments whose name is
+    neither a view variable nor a global, and which are used by
+    a nested scope; behaves (mostly) like the NameError that
+    using the name would raise under exec."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def _raise(self, *args, **kwargs):
+        raise NameError("name '%s' is not defined" % self.name)
+
+    __getattr__ = __call__ = __iter__ = __len__ = __nonzero__ = _raise
+    __getitem__ = __contains__ = __str__ = __unicode__ = _raise
+    __add__ = __sub__ = __mul__ = __div__ = __mod__ = __eq__ = __ne__ = _raise
+
+_unbound = object()
+
+# builtins which look at (or run code in) the calling namespace, and so
+# would see a function's arguments rather than the view variables
+_NAMESPACE_BUILTINS = frozenset(('locals', 'vars', 'dir', 'eval', 'execfile'))
+
+class _ViewNames(ast.NodeVisitor):
+    """Collects the names which view code assigns (or deletes) at
+    the top level, and every name it loads, including in nested
+    functions which may close over the top-level names. Also flags
+    statements which can't be moved into a function body."""
+
+    def __init__(self):
+        self.stored = set()
+        self.loaded = set()
+        self.nested_loaded = set()
+        self.declared_global = set()
+        self.unsupported = False
+        self.depth = 0
+
+    def bind(self, name):
+        if self.depth == 0:
+            self.stored.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.loaded.add(node.id)
+            if self.depth:
+                self.nested_loaded.add(node.id)
+        elif not isinstance(node.ctx, ast.Param):
+            self.bind(node.id)
+
+    def visit_Global(self, node):
+        if self.depth == 0:
+            self.declared_global.update(node.names)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.bind(alias.asname or alias.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.unsupported = True
+            self.bind(alias.asname or alias.name)
+
+    def visit_Exec(self, node):
+        if node.globals is None:
+            self.unsupported = True
+        self.generic_visit(node)
+
+    def visit_Return(self, node):
+        self.unsupported = self.unsupported or self.depth == 0
+        self.generic_visit(node)
+
+    def visit_Yield(self, node):
+        self.unsupported = self.unsupported or self.depth == 0
+        self.generic_visit(node)
+
+    def nested(self, node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    def visit_FunctionDef(self, node):
+        self.bind(node.name)
+        self.nested(node)
+
+    def visit_ClassDef(self, node):
+        self.bind(node.name)
+        self.nested(node)
+
+    visit_Lambda = visit_GeneratorExp = visit_SetComp = visit_DictComp = nested
+
+def _compile_template(args):
+    """Compile a Jinja template in a warm_up() worker process, and
+    return its marshalled code, or None if it fails to compile (the
+    error will be raised again when the engine compiles it)."""
+    options, name, filename, source = args
+    try:
+        code = jinja2.Environment(**options).compile(source, name, filename)
+    except Exception:
+        return None
+    return marshal.dumps(code)
+
+class MemoryBytecodeCache(jinja2.BytecodeCache):
+    """Keeps compiled Jinja templates in memory. Several engines can
+    share one, so that an engine which is thrown away and re-created
+    (as VirtualHosts does with idle sites) need not compile its
+    templates again."""
+
+    def __init__(self):
+        self.buckets = {}
+
+    def load_bytecode(self, bucket):
+        checksum, code = self.buckets.get(bucket.key, (None, None))
+        if checksum == bucket.checksum:
+            bucket.code = code
+
+    def dump_bytecode(self, bucket):
+        self.buckets[bucket.key] = (bucket.checksum, bucket.code)
+
+def _compiled_size(jinja_template):
+    """Estimate the memory used by a compiled Jinja template from
+    the size of its marshalled render functions."""
+    funcs = [jinja_template.root_render_func] + jinja_template.blocks.values()
+    return sum(len(marshal.dumps(func.func_code)) for func in funcs)
+
+def _template_size(template):
+    """Estimate the memory used by a Template and the body it holds."""
+    body = template._body
+    return sys.getsizeof(template) + (sys.getsizeof(body) if body is not None else 0)
+
+class _Entry(object):
+    """One template in a TemplateCache: the parsed Template, the Jinja
+    template compiled from it (once Jinja has compiled it), and their
+    estimated size in bytes."""
+
+    __slots__ = ('template', 'compiled', 'compiled_size', 'size', 'used')
+
+    def __init__(self, template, used):
+        self.template = template
+        self.compiled = None
+        self.compiled_size = 0
+        self.size = _template_size(template)
+        self.used = used
+
+class _CompiledView(object):
+    """The Jinja environment's view of a TemplateCache, which Jinja
+    uses in place of its own cache of compiled templates."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key, default=None):
+        compiled = self.cache.get_compiled(self.name(key))
+        return default if compiled is None else compiled
+
+    def __getitem__(self, key):
+        compiled = self.get(key)
+        if compiled is None:
+            raise KeyError(key)
+        return compiled
+
+    def __setitem__(self, key, compiled):
+        self.cache.set_compiled(self.name(key), compiled)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.cache)
+
+    def clear(self):
+        self.cache.clear()
+
+    def name(self, key):
+        # newer versions of Jinja key the cache on (loader, name)
+        return key[-1] if isinstance(key, tuple) else key
+
+class TemplateCache(object):
+    """Holds parsed Templates and the Jinja templates compiled from
+    them, as one entry per template, so that a single limit on the
+    number of entries and on their estimated size in bytes applies
+    to both. When a limit is exceeded, the least recently used
+    entries which are not pinned are evicted, down to 90% of the
+    limit. The entry just added is never evicted, so a template larger
+    than the byte limit is still kept, alone.
+
+    Reads take no lock: each lookup stamps the entry with a counter,
+    and changes swap in a copy of the entries dictionary.
+
+    Unless `release_sources` is False, each Template's body is
+    released once Jinja has compiled it.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, pinned=(), release_sources=True):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.release_sources = release_sources
+        self.entries = {}
+        self.bytes = 0
+        self.clock = itertools.count()
+        self.lock = threading.Lock()
+        self.compiled = _CompiledView(self)
+
+        self.hits = self.misses = 0
+        self.compiled_hits = self.compiled_misses = 0
+        self.evictions = 0
+
+    def get(self, name, default=None):
+        entry = self.entries.get(name)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        entry.used = next(self.clock)
+        return entry.template
+
+    def __getitem__(self, name):
+        template = self.get(name)
+        if template is None:
+            raise KeyError(name)
+        return template
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, name, template):
+        """Add or replace the Template for `name`; any compiled
+        Jinja template for its previous version is dropped."""
+        with self.lock:
+            entries = dict(self.entries)
+            old = entries.get(name)
+            if old is not None:
+                self.bytes -= old.size
+            entry = entries[name] = _Entry(template, next(self.clock))
+            self.bytes += entry.size
+            self.entries = self.evict(entries, name)
+
+    def get_compiled(self, name):
+        entry = self.entries.get(name)
+        if entry is None or entry.compiled is None:
+            self.compiled_misses += 1
+            return None
+        self.compiled_hits += 1
+        entry.used = next(self.clock)
+        return entry.compiled
+
+    def set_compiled(self, name, compiled):
+        """Store the compiled Jinja template alongside the Template
+        for `name`. If that was evicted in the meantime, the compiled
+        template isn't kept either."""
+        size = _compiled_size(compiled)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return
+            if self.release_sources:
+                entry.template.release()
+            entry.compiled = compiled
+            entry.compiled_size = size
+
+            self.bytes -= entry.size
+            entry.size = _template_size(entry.template) + size
+            self.bytes += entry.size
+            self.entries = self.evict(dict(self.entries), name)
+
+    def pin(self, name):
+        """Never evict the template `name` (which need not be loaded yet)."""
+        with self.lock:
+            self.pinned.add(name)
+
+    def unpin(self, name):
+        with self.lock:
+            self.pinned.discard(name)
+
+    def evict(self, entries, keep=None):
+        """Remove least recently used entries other than `keep` from
+        `entries` until it is within 90% of the limits. Must be called
+        with the lock held."""
+        over_entries = self.max_entries is not None and len(entries) > self.max_entries
+        over_bytes = self.max_bytes is not None and self.bytes > self.max_bytes
+        if not (over_entries or over_bytes):
+            return entries
+
+        max_entries = max(1, int(self.max_entries * 0.9)) if self.max_entries is not None else None
+        max_bytes = self.max_bytes * 0.9 if self.max_bytes is not None else None
+        candidates = sorted((entry.used, name) for name, entry in entries.iteritems()
+                            if name not in self.pinned and name != keep)
+        for used, name in candidates:
+            if (max_entries is None or len(entries) <= max_entries) and \
+               (max_bytes is None or self.bytes <= max_bytes):
+                break
+            self.bytes -= entries.pop(name).size
+            self.evictions += 1
+        return entries
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.bytes = 0
+
+    def footprint(self):
+        """Return a list of (name, estimated bytes) for each template
+        in the cache, largest first."""
+        sizes = [(name, entry.size) for name, entry in self.entries.items()]
+        return sorted(sizes, key=lambda item: item[1], reverse=True)
+
+    def stats(self):
+        """Return a dictionary of counters describing the cache."""
+        return {
+            'entries': len(self.entries),
+            'compiled': sum(1 for e in self.entries.itervalues() if e.compiled is not None),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'compiled_hits': self.compiled_hits,
+            'compiled_misses': self.compiled_misses,
+            'evictions': self.evictions,
+            'pinned': len(self.pinned),
+        }
 
 jinja_env = None
 class RenderEngine(object):
-    def __init__(self, app):
+    """Loads, caches, and renders .ks templates.
+
+    The engine is safe to share between threads. Each Template in
+    self.templates is treated as an immutable snapshot of one version
+    (mtime) of its file; when a file changes, a single thread parses
+    it and publishes the new snapshot in the TemplateCache, which
+    readers never need to lock. The Jinja environment keeps its
+    compiled templates in the same cache.
+
+    Each file is checked for changes at most once every
+    `check_interval` seconds (by default, whenever it is used). If
+    `minify` is True, templates are minified as they are compiled.
+    """
+
+    def __init__(self, app, bytecode_cache=None, template_cache=None, check_interval=0,
+                 minify=False):
         self.app = app
-        self.templates = {}
+        self.check_interval = check_interval
+        # maps template name => time its file was last checked
+        self.checked = {}
+        if template_cache is None:
+            template_cache = TemplateCache()
+        self.templates = template_cache
+        self.parse_locks = {}
+        self.shared_globals = {}
+        self.lock = threading.Lock()
+        self.providers = ContextProviders()
+        self.own_filters = set()
+
+        # the names of the templates which get_template() last checked
+        # for changes in each thread, which need not be checked again
+        # while rendering the page
+        self.local = threading.local()
+
+        # options for the Jinja environment which affect how templates
+        # are compiled; warm_up() needs them to compile in other processes
+        self.jinja_options = {
+            'extensions': [FlushExtension],
+        }
+        if minify:
+            self.jinja_options['extensions'].append(MinifyExtension)
+            self.jinja_options['trim_blocks'] = True
+            # added in Jinja 2.7
+            if 'lstrip_blocks' in inspect.getargspec(jinja2.Environment.__init__)[0]:
+                self.jinja_options['lstrip_blocks'] = True
 
         global jinja_env
-        jinja_env = jinja2.Environment(
-            loader=jinja2.FunctionLoader(self.get_template_body))
+        self.jinja_env = jinja_env = jinja2.Environment(
+            loader=jinja2.FunctionLoader(self.get_template_body),
+            bytecode_cache=bytecode_cache,
+            **self.jinja_options)
+        self.jinja_env.cache = self.templates.compiled
+
+    @contextlib.contextmanager
+    def starting(self):
+        """Within this context, template_filter() registers filters
+        in this engine's environment, regardless of which engine was
+        created most recently."""
+        _starting.engine = self
+        try:
+            yield
+        finally:
+            _starting.engine = None
+
+    def import_filters(self, module):
+        """Register the filters of the modules which `module` imports
+        (or imports names from), since they were only registered in
+        the engine which was starting when each was first imported.
+        Filters which this engine registered itself take precedence.
+        """
+        names = set()
+        for value in vars(module).values():
+            if isinstance(value, types.ModuleType):
+                names.add(value.__name__)
+            else:
+                names.add(getattr(value, '__module__', None))
+        # other applications' startup.py have the same module name
+        names.discard(module.__name__)
+        for name in names:
+            for filter_name, func in _module_filters.get(name, {}).iteritems():
+                if filter_name not in self.own_filters:
+                    self.jinja_env.filters[filter_name] = func
 
     def parse(self, fileobj):
         """Parse a .ks file into a view callable and a template
@@ -91,31 +800,21 @@ class RenderEngine(object):
         part is treated as the template, and the view callable is
         a no-op.
         """
-        first, second = [], []
-        active = first
-
-        for lineno, line in enumerate(fileobj):
-            if line.strip() == '----':
-                if active is second:
-                    raise InvalidTemplate(
-                        'Line %d: separator already seen on line %d' % (lineno, len(first)))
-                active = second
-            else:
-                active.append(line)
+        viewcode_str, body = _sections(fileobj)
+        if viewcode_str is None:
+            return Template(viewfunc=_no_view, body=body)
 
-        if active is first:
-            return Template(
-                viewfunc=lambda x: x,
-                body=''.join(first))
-
-        viewcode, viewglobals = self.compile(''.join(first), fileobj.name)
-        def viewfunc(viewlocals):
-            exec viewcode in viewglobals, viewlocals
-            return viewlocals
+        viewcode, viewglobals = self.compile(viewcode_str, fileobj.name)
+        viewfunc = self.make_viewfunc(viewcode_str, fileobj.name, viewglobals)
+        if viewfunc is None:
+            def viewfunc(viewlocals):
+                exec viewcode in viewglobals, viewlocals
+                return viewlocals
 
         return Template(
             viewfunc=viewfunc,
-            body=''.join(second))
+            body=body,
+            options=self.directives(viewcode_str))
 
     def compile(self, viewcode_str, filename):
         """Compile the view code and return a code object
@@ -144,28 +843,238 @@ class RenderEngine(object):
                             asname = name
                         viewglobals[asname] = getattr(module, name)
 
+        # templates which import the same things share one dictionary
+        # of globals, unless their view code could change it
+        if not _GLOBALS_RE.search(viewcode_str):
+            key = tuple(sorted((name, id(value)) for name, value in viewglobals.iteritems()))
+            viewglobals = self.shared_globals.setdefault(key, viewglobals)
+
         return viewcode, viewglobals
 
+    def make_viewfunc(self, viewcode_str, filename, viewglobals):
+        """Turn the view code into the body of a real function, so
+        that it runs with fast locals rather than being exec'd in a
+        dictionary on every request. Every name the code uses becomes
+        an argument, so that view variables can be passed in; the
+        function returns its locals().
+
+        Returns a viewfunc with the same behavior as exec'ing the view
+        code in the viewlocals, or None if the view code does something
+        that is only allowed at module level (like "import *"), or uses
+        its namespace dynamically (like "locals()" or "eval()").
+        """
+        tree = ast.parse(viewcode_str, filename)
+        names = _ViewNames()
+        for stmt in tree.body:
+            names.visit(stmt)
+        params = sorted((names.stored | names.loaded) - names.declared_global)
+        if names.unsupported or len(params) > 254 or \
+           'locals' in names.stored or '_keystone_unbound' in params or \
+           names.loaded & _NAMESPACE_BUILTINS:
+            return None
+
+        # names which the view code doesn't get passed, or doesn't
+        # assign, keep the value they would have had under exec
+        builtins = viewglobals['__builtins__']
+        builtins = getattr(builtins, '__dict__', builtins)
+        defaults, prologue = [], []
+        inherited = {}
+        for name in params:
+            if name in viewglobals:
+                # bound by a top-level import, so always a view variable
+                defaults.append(viewglobals[name])
+            elif name in builtins:
+                defaults.append(builtins[name])
+                inherited[name] = builtins[name]
+            elif name in names.nested_loaded:
+                # Python 2 can't del a name used by a nested scope
+                defaults.append(_Unbound(name))
+            else:
+                # so that using the name raises UnboundLocalError
+                defaults.append(_unbound)
+                prologue.append(ast.If(
+                    ast.Compare(ast.Name(name, ast.Load()), [ast.Is()], [ast.Name('_keystone_unbound', ast.Load())]),
+                    [ast.Delete([ast.Name(name, ast.Del())])], []))
+
+        body = prologue + tree.body + [ast.Return(
+            ast.Call(ast.Name('locals', ast.Load()), [], [], None, None))]
+        funcdef = ast.FunctionDef(
+            'view',
+            ast.arguments([ast.Name(name, ast.Param()) for name in params + ['_keystone_unbound']], None, None,
+                          [ast.Name('None', ast.Load()) for name in params + ['_keystone_unbound']]),
+            body, [], lineno=1, col_offset=0)
+        module = ast.fix_missing_locations(ast.Module([funcdef]))
+
+        namespace = {}
+        exec compile(module, filename, 'exec') in viewglobals, namespace
+        func = namespace['view']
+        func.func_defaults = tuple(defaults) + (_unbound, )
+
+        params = frozenset(params)
+        stored = names.stored
+
+        def viewfunc(viewlocals):
+            args = dict((k, v) for k, v in viewlocals.iteritems() if k in params)
+            namespace = func(**args)
+            for name in stored:
+                value = namespace.get(name, _unbound)
+                # a builtin which the view code only assigns in a
+                # branch that didn't run is still its default
+                if value is _unbound or isinstance(value, _Unbound) or \
+                   (name not in args and value is inherited.get(name, _unbound)):
+                    viewlocals.pop(name, None)
+                else:
+                    viewlocals[name] = value
+            return viewlocals
+
+        return viewfunc
+
+    def directives(self, viewcode_str):
+        """Return a dictionary of options set by top-level assignments
+        of constants to any of the names in DIRECTIVES, for instance
+        "__cache__ = 60". The assignments are still executed along
+        with the rest of the view code.
+        """
+        options = {}
+        for stmt in compiler.parse(viewcode_str).node:
+            if not isinstance(stmt, Assign) or len(stmt.nodes) != 1:
+                continue
+            target = stmt.nodes[0]
+            if not isinstance(target, AssName) or target.name not in DIRECTIVES:
+                continue
+
+            if isinstance(stmt.expr, Const):
+                value = stmt.expr.value
+            elif isinstance(stmt.expr, Name) and stmt.expr.name in ('True', 'False', 'None'):
+                value = {'True': True, 'False': False, 'None': None}[stmt.expr.name]
+            else:
+                raise InvalidTemplate(
+                    'Line %d: %s must be assigned a constant' % (stmt.lineno, target.name))
+
+            options[DIRECTIVES[target.name]] = value
+
+        return options
+
+    def references(self, body, name):
+        """Return the names of the templates which the template body
+        extends, includes or imports, whether it also refers to
+        templates whose names are only known at runtime, and whether
+        it uses any variables other than the environment's globals."""
+        try:
+            tree = self.jinja_env.parse(body, name)
+            names = list(jinja2.meta.find_referenced_templates(tree))
+            variables = jinja2.meta.find_undeclared_variables(tree) - set(self.jinja_env.globals)
+        except jinja2.TemplateError:
+            # reported when the template is compiled
+            return (), False, True
+        return tuple(n for n in names if n is not None), None in names, bool(variables)
+
     def refresh_if_needed(self, name):
         """Update the cached modification time, view func,
         and template body for the .ks template at the given
-        path relative to the app_dir."""
+        path relative to the app_dir, and return the Template."""
+        template = self.templates.get(name)
+        now = time.time()
+        if template is not None and self.check_interval and \
+           now - self.checked.get(name, 0) < self.check_interval:
+            return template
+
         filename = os.path.abspath(os.path.join(self.app.app_dir, name))
-        if not os.path.isfile(filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
             raise TemplateNotFound('could not find template %s' % name)
 
-        mtime = os.stat(filename).st_mtime
-        template = self.templates.get(name)
+        mtime = st.st_mtime
+        self.checked[name] = now
+        if template is not None and template.mtime >= mtime:
+            return template
+
+        with self.lock:
+            parse_lock = self.parse_locks.setdefault(name, threading.Lock())
+
+        with parse_lock:
+            # another thread may have parsed it while we waited
+            template = self.templates.get(name)
+            if template is not None and template.mtime >= mtime:
+                return template
 
-        if template is None or template.mtime < mtime:
-            template = self.parse(file(filename, 'rb'))
+            fileobj = file(filename, 'rb')
+            try:
+                template = self.parse(fileobj)
+            finally:
+                fileobj.close()
             template.mtime = mtime
-            template.name = name
-            self.templates[name] = template
+            template.name = _intern(name)
+            template.source = filename
+            dependencies, template.dynamic, template.uses_context = self.references(template.body, name)
+            template.dependencies = tuple(_intern(d) for d in dependencies)
+            self.templates.put(name, template)
+            return template
+
+    def warm_up(self, processes=None, pool_threshold=50):
+        """Parse every .ks template in the app_dir and compile its Jinja
+        template ahead of the first request for it. If there are at
+        least `pool_threshold` templates, the Jinja templates are
+        compiled by a pool of `processes` processes (by default, one
+        per CPU). Templates which fail to load are skipped with a
+        warning, and will fail again when requested.
+        """
+        app_dir = self.app.app_dir
+        names = []
+        for dirpath, dirnames, filenames in os.walk(app_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.endswith('.ks'):
+                    names.append(os.path.join(dirpath, filename)[len(app_dir) + 1:])
+
+        loaded = []
+        for name in sorted(names):
+            try:
+                self.refresh_if_needed(name)
+                loaded.append(name)
+            except Exception, e:
+                warnings.warn('could not load template %s: %s' % (name, e))
+
+        bcc = self.jinja_env.bytecode_cache
+        if len(loaded) >= pool_threshold and processes != 1:
+            if bcc is None:
+                # just long enough to hand over the compiled templates
+                self.jinja_env.bytecode_cache = MemoryBytecodeCache()
+
+            jobs = []
+            for name in loaded:
+                filename = os.path.join(app_dir, name)
+                body = self.refresh_if_needed(name).body
+                jobs.append((self.jinja_options, name, filename, body))
+
+            pool = multiprocessing.Pool(processes)
+            try:
+                compiled = pool.map(_compile_template, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+            for (options, name, filename, source), code in zip(jobs, compiled):
+                if code is not None:
+                    bucket = self.jinja_env.bytecode_cache.get_bucket(self.jinja_env, name, filename, source)
+                    bucket.code = marshal.loads(code)
+                    self.jinja_env.bytecode_cache.set_bucket(bucket)
+
+        try:
+            for name in loaded:
+                try:
+                    self.jinja_env.get_template(name)
+                except Exception, e:
+                    warnings.warn('could not compile template %s: %s' % (name, e))
+        finally:
+            self.jinja_env.bytecode_cache = bcc
 
     def render(self, template, viewlocals):
         """Template rendering entry point."""
-        jinja_template = jinja_env.get_template(template.name)
+        jinja_template = self.jinja_env.get_template(template.name)
         viewlocals.update(template.urlparams)
         try:
             return jinja_template.generate(**template.viewfunc(viewlocals))
@@ -173,19 +1082,77 @@ class RenderEngine(object):
             return stop.body
 
     def get_template(self, name):
-        self.refresh_if_needed(name)
-        return self.templates.get(name)
+        """Return the Template for `name`, after checking it and every
+        template it depends on for changes, once each. Rendering it in
+        the same thread then needn't check them again."""
+        template = self.refresh_if_needed(name)
+        fresh, pending = set([name]), list(template.dependencies)
+        while pending:
+            dependency = pending.pop()
+            if dependency in fresh:
+                continue
+            fresh.add(dependency)
+            try:
+                pending.extend(self.refresh_if_needed(dependency).dependencies)
+            except Exception:
+                # Jinja raises it again when it loads the template
+                pass
+
+        self.local.fresh = fresh
+        return template
+
+    def current(self, name):
+        """Return the Template for `name`, checking it for changes
+        unless get_template() has just done so for the page being
+        rendered in this thread."""
+        if name in getattr(self.local, 'fresh', ()):
+            template = self.templates.get(name)
+            if template is not None:
+                return template
+        return self.refresh_if_needed(name)
+
+    def closure(self, name):
+        """Return the loaded Templates for `name` and all the templates
+        it depends on, directly or indirectly."""
+        templates, seen, pending = [], set(), [name]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            template = self.templates.get(name)
+            if template is not None:
+                templates.append(template)
+                pending.extend(template.dependencies)
+        return templates
+
+    def is_static(self, name):
+        """Return True if the template `name` renders the same page on
+        every request: neither it nor any template it depends on has
+        view code or uses variables, and all of them are loaded."""
+        closure = self.closure(name)
+        names = set(t.name for t in closure)
+        for template in closure:
+            if template.viewfunc is not _no_view or template.uses_context or template.dynamic:
+                return False
+            if not names.issuperset(template.dependencies):
+                return False
+        return bool(closure)
+
+    def version(self, name):
+        """Return a version for `name` which changes whenever it or any
+        template it depends on changes: the latest of their mtimes."""
+        return max([t.mtime for t in self.closure(name)] or [None])
 
     def get_template_body(self, name):
         """Jinja2 template loader function."""
-        self.refresh_if_needed(name)
-        template = self.templates[name]
+        template = self.current(name)
         cached_mtime = template.mtime
 
         def uptodate():
-            self.refresh_if_needed(name)
-            template = self.templates[name]
+            template = self.current(name)
             return template and template.mtime and cached_mtime and template.mtime <= cached_mtime
 
-        return template.body, name, uptodate
+        filename = os.path.abspath(os.path.join(self.app.app_dir, name))
+        return template.body, filename, uptodate
 
@@ -39,11 +39,26 @@ def main():
                         help='Hostname or IP address to listen on [0.0.0.0]')
     parser.add_argument('-t', '--threaded', dest='threaded', action='store_const', const=True, default=False,
                         help='Use threads for concurrency; always False if -d/--debug is set [False]')
-    parser.add_argument('-d', '--debug', dest='debug', action='store_const', const=False, default=True,
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False,
                         help='Display Python tracebacks in the browser [False]')
     parser.add_argument('-e', '--static-expires', dest='static_expires', action='store', default=86400, type=int,
                         help='Serve static files with expiry of STATIC_EXPIRES seconds [86400]')
 
+    parser.add_argument('-w', '--workers', dest='workers', metavar='WORKERS', type=int, default=0,
+                        help='Serve from WORKERS forked processes, for production; 0 runs the development server [0]')
+    parser.add_argument('--threads', dest='threads', metavar='THREADS', type=int, default=16,
+                        help='Connections handled at once by each worker [16]')
+    parser.add_argument('--keepalive', dest='keepalive', metavar='SECONDS', type=int, default=5,
+                        help='Close connections idle for SECONDS seconds; 0 disables keep-alive [5]')
+    parser.add_argument('--reuse-port', dest='reuse_port', action='store_true', default=False,
+                        help='Give each worker its own socket with SO_REUSEPORT [False]')
+    parser.add_argument('--graceful-timeout', dest='graceful_timeout', metavar='SECONDS', type=int, default=30,
+                        help='Kill workers still busy SECONDS seconds after shutdown begins [30]')
+    parser.add_argument('--preload', dest='preload', action='store_true', default=False,
+                        help='Load the application once, before forking workers [False]')
+    parser.add_argument('--warm-up', dest='warm_up', action='store_true', default=False,
+                        help='Compile every template when the application is loaded [False]')
+
     parser.add_argument('--configure', dest='paas', action='store', choices=['wsgi', 'heroku', 'dotcloud', 'epio'],
                         help='Set up configuration files in app_dir for PaaS services')
 
@@ -69,6 +84,13 @@ def serve(parser, args):
     extra = {}
     if args.static_expires:
         extra['static_expires'] = int(args.static_expires)
+    if args.warm_up:
+        extra['warm_up'] = True
+
+    if args.workers:
+        if args.debug:
+            parser.error('-d/--debug cannot be used with -w/--workers')
+        return serve_prefork(args, extra)
 
     app = Keystone(app_dir=args.app_dir, **extra)
     return werkzeug.serving.run_simple(
@@ -81,6 +103,26 @@ def serve(parser, args):
         threaded=args.threaded,
     )
 
+def serve_prefork(args, extra):
+    from keystone.main import Keystone
+    from keystone.server import PreforkServer
+
+    def make_app():
+        return Keystone(app_dir=args.app_dir, **extra)
+
+    server = PreforkServer(
+        make_app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        threads=args.threads,
+        keepalive=args.keepalive,
+        reuse_port=args.reuse_port,
+        graceful_timeout=args.graceful_timeout,
+        preload=args.preload,
+    )
+    return server.serve_forever()
+
 def configure(parser, args):
     import keystone
 
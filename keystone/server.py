@@ -0,0 +1,319 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import with_statement
+
+__all__ = ('PreforkServer', 'PooledWSGIServer', 'KeepAliveHandler', 'listen')
+
+import errno
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, select_ip_version
+
+from keystone.pool import ThreadPool
+
+def listen(host, port, reuse_port=False, backlog=128):
+    """Return a socket listening on (host, port), or only bound to it
+    if `backlog` is None. With `reuse_port`, several sockets may listen
+    on the same address, and the kernel spreads connections between
+    them."""
+    sock = socket.socket(select_ip_version(host, port), socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, int(port)))
+    if backlog is not None:
+        sock.listen(backlog)
+    return sock
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """Speaks HTTP/1.1, and so keeps connections open between requests
+    until the client has been idle for the server's `keepalive`
+    seconds, or closes them after each request if that is 0."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.keepalive or None
+        WSGIRequestHandler.setup(self)
+
+    def handle_one_request(self):
+        WSGIRequestHandler.handle_one_request(self)
+        if self.should_close():
+            self.close_connection = 1
+
+    def end_headers(self):
+        if not self.close_connection and self.should_close():
+            self.close_connection = 1
+            self.send_header('Connection', 'close')
+        WSGIRequestHandler.end_headers(self)
+
+    def should_close(self):
+        if self.server.stopping or not self.server.keepalive:
+            return True
+        # the application may not have read all of a request body,
+        # which would then be mistaken for the next request
+        headers = getattr(self, 'headers', None)
+        return headers is not None and (
+            headers.get('Content-Length', '0') not in ('', '0')
+            or 'Transfer-Encoding' in headers)
+
+class PooledWSGIServer(BaseWSGIServer):
+    """A WSGI server which handles connections in a ThreadPool of
+    at most `threads` threads. It listens on `listener` if given,
+    rather than binding a socket of its own."""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=16, keepalive=5,
+                 listener=None, reuse_port=False, handler=KeepAliveHandler):
+        self.listener = listener
+        self.reuse_port = reuse_port
+        self.keepalive = keepalive
+        self.stopping = False
+        # accept no more connections than there are threads free to
+        # handle them, leaving the rest to other workers
+        self.pool = ThreadPool(size=threads, max_queue=1)
+        BaseWSGIServer.__init__(self, host, port, app, handler)
+
+    def server_bind(self):
+        if self.listener is None:
+            if self.reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            return BaseWSGIServer.server_bind(self)
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def server_activate(self):
+        if self.listener is None:
+            BaseWSGIServer.server_activate(self)
+        # several processes may wait on the same socket; those which
+        # lose the race to accept a connection must not block
+        self.socket.setblocking(False)
+
+    def serve_forever(self, poll_interval=0.5):
+        while not self.stopping:
+            try:
+                ready = select.select([self], [], [], poll_interval)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if ready and not self.stopping:
+                self._handle_request_noblock()
+
+    def stop(self, *args):
+        """Stop accepting connections; serve_forever() returns shortly
+        after. Safe to use as a signal handler."""
+        self.stopping = True
+
+    def drain(self, timeout=None):
+        """Wait up to `timeout` seconds for the connections already
+        accepted to finish."""
+        threads = self.pool.threads
+        self.pool.close()
+        if timeout is None:
+            for thread in threads:
+                thread.join()
+            return
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+class PreforkServer(object):
+    """Serves the application returned by `make_app()` from `workers`
+    forked processes, each handling up to `threads` connections at
+    once. The workers share one listening socket, or, with
+    `reuse_port`, each listen on their own.
+
+    With `preload`, the application is created once in the master
+    process, before any worker is forked, so that workers share its
+    memory copy-on-write; the application's `after_fork()` method, if
+    it has one, is then called in each worker.
+
+    Workers which exit are replaced. On SIGTERM or SIGINT, workers
+    finish the requests they have started and exit, and are killed if
+    they take longer than `graceful_timeout` seconds."""
+
+    def __init__(self, make_app, host='0.0.0.0', port=5000, workers=4,
+                 threads=16, keepalive=5, reuse_port=False, graceful_timeout=30,
+                 preload=False):
+        self.make_app = make_app
+        self.preload = preload
+        self.app = None
+        self.host = host
+        self.workers = workers
+        self.threads = threads
+        self.keepalive = keepalive
+        self.reuse_port = reuse_port
+        self.graceful_timeout = graceful_timeout
+        self.children = {}
+        self.stopping = False
+        self.pid = None
+
+        # with reuse_port, the master only binds, so that the port is
+        # held (and known, if 0 was asked for) without the kernel
+        # sending it connections which no worker would accept
+        backlog = None if reuse_port else 128
+        self.listener = listen(host, port, reuse_port, backlog)
+        self.port = self.listener.getsockname()[1]
+
+    def serve_forever(self):
+        self.pid = os.getpid()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        self.log(' * Running on http://%s:%d/ with %d workers of %d threads',
+                 self.host, self.port, self.workers, self.threads)
+
+        try:
+            if self.preload:
+                self.app = self.make_app()
+            while True:
+                while not self.stopping and len(self.children) < self.workers:
+                    self.spawn()
+                if not self.children:
+                    break
+
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno == errno.ECHILD:
+                        break
+                    raise
+
+                if self.children.pop(pid, None) and status and not self.stopping:
+                    if os.WIFSIGNALED(status):
+                        self.log(' * Worker %d killed by signal %d', pid, os.WTERMSIG(status))
+                    else:
+                        self.log(' * Worker %d exited with status %d', pid, os.WEXITSTATUS(status))
+                    # don't spin if the application fails at startup
+                    self.sleep(1)
+        finally:
+            signal.alarm(0)
+            self.listener.close()
+            if callable(getattr(self.app, 'close', None)):
+                self.app.close()
+
+    def stop(self, *args):
+        """Ask every worker to exit once its requests have finished."""
+        if self.stopping or os.getpid() != self.pid:
+            # a new worker signalled before it set up its own handlers
+            self.stopping = True
+            return
+        self.stopping = True
+        for pid in self.children:
+            self.signal(pid, signal.SIGTERM)
+        if self.graceful_timeout:
+            signal.alarm(self.graceful_timeout)
+
+    def kill(self, *args):
+        for pid in self.children:
+            self.signal(pid, signal.SIGKILL)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            if self.stopping:
+                self.signal(pid, signal.SIGTERM)
+            return
+
+        status = 1
+        try:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            status = self.work()
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def work(self):
+        """Serve requests in a worker process until told to stop."""
+        # with reuse_port, each worker listens on its own socket, so
+        # that the kernel balances connections between them
+        listener = self.listener
+        if self.reuse_port:
+            listener = listen(self.host, self.port, reuse_port=True)
+            self.listener.close()
+
+        if self.preload:
+            app = self.app
+            if callable(getattr(app, 'after_fork', None)):
+                app.after_fork()
+        else:
+            app = self.make_app()
+        server = PooledWSGIServer(
+            self.host, self.port, app, threads=self.threads,
+            keepalive=self.keepalive, listener=listener)
+        server.multiprocess = self.workers > 1
+        signal.signal(signal.SIGTERM, server.stop)
+        signal.signal(signal.SIGINT, server.stop)
+        if self.stopping:
+            return 0
+
+        server.serve_forever()
+        server.drain(self.graceful_timeout)
+        if callable(getattr(app, 'close', None)):
+            app.close()
+        return 0
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def sleep(self, seconds):
+        try:
+            time.sleep(seconds)
+        except IOError:
+            pass
+
+    def log(self, message, *args):
+        sys.stderr.write((message % args) + '\n')
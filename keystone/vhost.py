@@ -0,0 +1,163 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from __future__ import with_statement
+
+__all__ = ('VirtualHosts', )
+
+import os, os.path
+import threading
+import time
+
+from keystone import http
+from keystone.main import Keystone
+from keystone.pool import ThreadPool
+from keystone.render import MemoryBytecodeCache
+
+class VirtualHosts(object):
+    """A WSGI application which serves many Keystone applications
+    from one process, choosing among them by the request's Host.
+
+    Sites are named explicitly in `hosts`, a dictionary of host
+    names to application directories, or found as directories
+    named for the host under `root`. Each site gets its own
+    Keystone instance, with its own templates and filters, created
+    the first time it is requested. Sites are closed and unloaded
+    when more than `max_apps` are loaded, least recently used
+    first, or when they have received no requests for
+    `idle_timeout` seconds.
+
+    Any other keyword arguments are passed on to every Keystone
+    instance, except that each site mirrors its cached pages into
+    its own directory, named for the host, under `mirror_dir`.
+    Unless one is given, all sites share a
+    MemoryBytecodeCache, so that unloaded sites start up again
+    without recompiling their templates, and ThreadPools for
+    deferred and after-response calls, so that the number of threads
+    doesn't grow with the number of sites. Each site starts its own
+    ProcessPool for offloaded calls, whose workers use the site's own
+    startup.py; a process_pool passed in is shared, and so must only
+    run functions from modules whose names are unique to one site.
+    """
+
+    def __init__(self, hosts=None, root=None, max_apps=None, idle_timeout=None, **options):
+        self.hosts = dict((host.lower(), app_dir) for host, app_dir in (hosts or {}).iteritems())
+        self.root = root and os.path.abspath(root)
+        self.max_apps = max_apps
+        self.idle_timeout = idle_timeout
+
+        self.options = options
+        self.mirror_root = self.options.pop('mirror_dir', None)
+        self.options.setdefault('bytecode_cache', MemoryBytecodeCache())
+        self.own_pools = [name for name in ('thread_pool', 'after_response_pool')
+                          if name not in options]
+        self.options.setdefault('thread_pool', ThreadPool())
+        self.options.setdefault('after_response_pool', ThreadPool(4, max_queue=1000))
+
+        # maps host name => [Keystone app, time of last request]
+        self.apps = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+
+    def app_dir(self, host):
+        """Return the application directory for `host`, or None."""
+        if host in self.hosts:
+            return self.hosts[host]
+
+        if self.root and host and not host.startswith('.') and os.sep not in host:
+            app_dir = os.path.join(self.root, host)
+            if os.path.isdir(app_dir):
+                return app_dir
+
+        return None
+
+    def get_app(self, host):
+        """Return the Keystone application for `host`, loading it if
+        needed, or None if there is no such site."""
+        host = host.split(':')[0].lower()
+        now = time.time()
+
+        entry = self.apps.get(host)
+        if entry is None:
+            with self.lock:
+                entry = self.apps.get(host)
+                if entry is None:
+                    app_dir = self.app_dir(host)
+                    if app_dir is None:
+                        return None
+                    options = self.options
+                    if self.mirror_root is not None:
+                        options = dict(options, mirror_dir=os.path.join(self.mirror_root, host))
+                    entry = [Keystone(app_dir, **options), now]
+                    self.apps[host] = entry
+
+        entry[1] = now
+        self.evict(now)
+        return entry[0]
+
+    def evict(self, now):
+        """Close and unload sites which have been idle too long, and
+        the least recently used sites beyond max_apps."""
+        too_many = self.max_apps is not None and len(self.apps) > self.max_apps
+        sweep_due = self.idle_timeout is not None and now - self.last_sweep >= 1
+        if not too_many and not sweep_due:
+            return
+
+        with self.lock:
+            self.last_sweep = now
+            by_age = sorted(self.apps.items(), key=lambda item: item[1][1])
+            evicted = []
+            for host, (app, last_used) in by_age:
+                if self.idle_timeout is not None and now - last_used >= self.idle_timeout:
+                    evicted.append(host)
+            if self.max_apps is not None:
+                for host, entry in by_age[:len(by_age) - self.max_apps]:
+                    if host not in evicted:
+                        evicted.append(host)
+
+            apps = [self.apps.pop(host)[0] for host in evicted]
+
+        for app in apps:
+            app.close()
+
+    def close(self):
+        """Close and unload all sites, and stop the pools which
+        VirtualHosts created."""
+        with self.lock:
+            apps = [app for app, last_used in self.apps.itervalues()]
+            self.apps.clear()
+        for app in apps:
+            app.close()
+        for name in self.own_pools:
+            # let tasks for responses already sent finish
+            self.options[name].close(wait=(name == 'after_response_pool'))
+
+    def __call__(self, environ, start_response):
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        app = self.get_app(host)
+        if app is None:
+            return http.NotFound()(environ, start_response)
+        return app(environ, start_response)
@@ -25,11 +25,15 @@
 
 from __future__ import with_statement
 
+import gzip
 import os
 import os.path
 import shutil
 import sys
+import threading
+import time
 import unittest
+from textwrap import dedent
 from inspect import getargspec
 from werkzeug.datastructures import Headers
 from werkzeug.wrappers import Request
@@ -172,7 +176,7 @@ class KeystoneTest(unittest.TestCase):
         self.assertEqual(response.data, '<strong>this is HTML</strong>')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.mimetype, 'text/html')
-        self.assertTrue('Content-Length' not in response.headers)
+        self.assertEqual(response.content_length, 29)
         self.assertTrue('ETag' not in response.headers)
         self.assertTrue('Last-Modified' not in response.headers)
         self.assertTrue('Expires' not in response.headers)
@@ -195,13 +199,338 @@ class KeystoneTest(unittest.TestCase):
         self.assertEqual(response.data, 'hello, world')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.mimetype, 'text/html')
-        self.assertTrue('Content-Length' not in response.headers)
+        self.assertEqual(response.content_length, 12)
         self.assertTrue('ETag' not in response.headers)
         self.assertTrue('Last-Modified' not in response.headers)
         self.assertTrue('Expires' not in response.headers)
         self.assertTrue('Cache-Control' not in response.headers)
         self.assertTrue('Set-Cookie' not in response.headers)
 
+    def test_output_chunks(self):
+        index = os.path.join(self.app_dir, 'index.ks')
+        with file(index, 'w') as fp:
+            fp.write('count = int(request.args["count"])\n----\n')
+            fp.write('{% for i in range(count) %}<p>{{i}}</p>{% endfor %}')
+
+        app = Keystone(self.app_dir, chunk_size=100, buffer_size=300)
+        template = app.engine.get_template('index.ks')
+
+        # small bodies are sent whole, with a Content-Length
+        response = app.render_keystone(Request(wsgi_environ('GET', '/?count=10')), template)
+        self.assertEqual(response.content_length, len(response.data))
+
+        # larger bodies are streamed in encoded chunks of chunk_size
+        response = app.render_keystone(Request(wsgi_environ('GET', '/?count=1000')), template)
+        self.assertTrue('Content-Length' not in response.headers)
+        chunks = list(response.response)
+        self.assertTrue(all(type(chunk) is str for chunk in chunks), 'chunks were not encoded')
+        self.assertTrue(all(100 <= len(chunk) < 110 for chunk in chunks[:-1]), 'chunks were not coalesced')
+        self.assertEqual(''.join(chunks), ''.join('<p>%d</p>' % i for i in range(1000)))
+
+    def test_flush(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write('calls = []\ndef slow():\n    calls.append(1)\n    return "body"\n')
+
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('from startup import slow\nvalue = lazy(slow)\n----\n')
+            fp.write('<head></head>{% flush %}{{value}}')
+
+        app = Keystone(self.app_dir)
+        template = app.engine.get_template('index.ks')
+        response = app.render_keystone(Request(wsgi_environ('GET', '/')), template)
+
+        calls = sys.modules['startup'].calls
+        self.assertEqual(calls, [], 'lazy value was computed before the flush')
+        self.assertTrue('Content-Length' not in response.headers)
+
+        chunks = iter(response.response)
+        self.assertEqual(chunks.next(), '<head></head>')
+        self.assertEqual(calls, [], 'lazy value was computed before it was used')
+        self.assertEqual(''.join(chunks), 'body')
+        self.assertEqual(calls, [1])
+
+    def test_defer(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write('import time\nfrom keystone import http\n')
+            fp.write('def slow(n):\n    time.sleep(0.2)\n    return n\n')
+            fp.write('def missing():\n    raise http.NotFound()\n')
+
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('from startup import slow\n')
+            fp.write('a, b = parallel(lambda: slow(1), lambda: slow(2))\nc = defer(slow, 3)\n----\n')
+            fp.write('{{a}} {{b}} {{c}}')
+        with file(os.path.join(self.app_dir, 'missing.ks'), 'w') as fp:
+            fp.write('from startup import missing\nx = defer(missing)\n----\n{{x}}')
+
+        app = Keystone(self.app_dir)
+        start = time.time()
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(''.join(response.response), '1 2 3')
+        self.assertTrue(time.time() - start < 0.5, 'deferred calls did not run concurrently')
+
+        response = app.dispatch(Request(wsgi_environ('GET', '/missing')))
+        self.assertEqual(response.status_code, 404)
+
+        app = Keystone(self.app_dir, defer_timeout=0.05)
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.status_code, 504)
+        app.close()
+
+    def test_offload(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write('import os, time\n')
+            fp.write('def pid(n):\n    return n, os.getpid()\n')
+            fp.write('def fail():\n    raise ValueError("bad")\n')
+            fp.write('def sleepy():\n    time.sleep(5)\n')
+
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('from startup import pid\nn, worker = offload(pid, 7)\n----\n{{n}}')
+        with file(os.path.join(self.app_dir, 'fail.ks'), 'w') as fp:
+            fp.write('from startup import fail\noffload(fail)\n----\n')
+        with file(os.path.join(self.app_dir, 'sleepy.ks'), 'w') as fp:
+            fp.write('from startup import sleepy\noffload(sleepy)\n----\n')
+
+        app = Keystone(self.app_dir, offload_timeout=0.5)
+        try:
+            response = app.dispatch(Request(wsgi_environ('GET', '/')))
+            self.assertEqual(''.join(response.response), '7')
+
+            startup = sys.modules['startup']
+            n, worker = app.process_pool.run(startup.pid, (1, ))
+            self.assertNotEqual(worker, os.getpid(), 'call was not run in another process')
+
+            try:
+                app.process_pool.run(startup.fail)
+                self.fail('exception was not raised')
+            except ValueError, e:
+                self.assertTrue('raise ValueError' in e.remote_traceback)
+
+            response = app.dispatch(Request(wsgi_environ('GET', '/fail')))
+            self.assertEqual(response.status_code, 500)
+            response = app.dispatch(Request(wsgi_environ('GET', '/sleepy')))
+            self.assertEqual(response.status_code, 504)
+        finally:
+            app.close()
+
+    def test_file_responses(self):
+        data = os.path.join(self.app_dir, '_data.csv')
+        with file(data, 'wb') as fp:
+            fp.write('0123456789')
+        with file(os.path.join(self.app_dir, 'whole.ks'), 'w') as fp:
+            fp.write('return_file(app_dir + "/_data.csv")\n----\n')
+        with file(os.path.join(self.app_dir, 'part.ks'), 'w') as fp:
+            fp.write('return_file(app_dir + "/_data.csv", 2, 3)\n----\n')
+        with file(os.path.join(self.app_dir, 'opened.ks'), 'w') as fp:
+            fp.write('fp = file(app_dir + "/_data.csv", "rb")\nfp.read(4)\n'
+                     'headers["Content-Type"] = "text/plain"\nreturn_response(fp)\n----\n')
+
+        class FileWrapper(object):
+            def __init__(self, fileobj, block_size):
+                self.fileobj = fileobj
+            def __iter__(self):
+                return iter([self.fileobj.read()])
+
+        app = Keystone(self.app_dir, auto_etag=True)
+        def get(path):
+            environ = wsgi_environ('GET', path)
+            environ['wsgi.file_wrapper'] = FileWrapper
+            return app.dispatch(Request(environ))
+
+        response = get('/whole')
+        self.assertTrue(isinstance(response.response, FileWrapper), 'file was not sent with wsgi.file_wrapper')
+        self.assertEqual(response.content_length, 10)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(''.join(response.response), '0123456789')
+
+        # a range which stops short of the end can't use the file wrapper
+        response = get('/part')
+        self.assertFalse(isinstance(response.response, FileWrapper))
+        self.assertEqual(response.content_length, 3)
+        self.assertEqual(''.join(response.response), '234')
+
+        # files passed to return_response are sent from their position
+        response = get('/opened')
+        self.assertTrue(isinstance(response.response, FileWrapper))
+        self.assertEqual(response.content_length, 6)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertEqual(''.join(response.response), '456789')
+
+        # chunk_size only applies to rendered templates
+        app = Keystone(self.app_dir, chunk_size=0)
+        client = Client(app, BaseResponse)
+        for path, data in (('/whole', '0123456789'), ('/part', '234'), ('/opened', '456789')):
+            response = client.get(path)
+            self.assertEqual(response.data, data)
+            self.assertEqual(response.headers['Content-Length'], str(len(data)))
+
+    def test_pipe_responses(self):
+        with file(os.path.join(self.app_dir, 'pipe.ks'), 'w') as fp:
+            fp.write('import subprocess\n'
+                     'proc = subprocess.Popen(["echo", "hello from pipe"], stdout=subprocess.PIPE)\n'
+                     'return_response(proc.stdout)\n----\n')
+
+        # pipes can't seek and have no size, so they are streamed
+        for chunk_size in (16384, 0):
+            client = Client(Keystone(self.app_dir, chunk_size=chunk_size), BaseResponse)
+            response = client.get('/pipe')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, 'hello from pipe\n')
+            self.assertFalse('Content-Length' in response.headers)
+
+    def test_stream_events(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write(dedent('''
+            import time
+            closed = []
+            def ticks():
+                try:
+                    yield 'one'
+                    yield {'event': 'tick', 'id': 2, 'data': 'two\\nlines'}
+                    time.sleep(0.3)
+                    yield 'three'
+                    while True:
+                        time.sleep(0.01)
+                        yield None
+                finally:
+                    closed.append(True)
+            '''))
+        with file(os.path.join(self.app_dir, 'events.ks'), 'w') as fp:
+            fp.write('from startup import ticks\nstream_events(ticks(), heartbeat=0.1)\n----\n')
+
+        app = Keystone(self.app_dir, auto_etag=True)
+        response = app.dispatch(Request(wsgi_environ('GET', '/events')))
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(response.headers['X-Accel-Buffering'], 'no')
+        self.assertTrue('Content-Length' not in response.headers)
+
+        events = iter(response.response)
+        self.assertEqual(events.next(), 'data: one\n\n')
+        self.assertEqual(events.next(), 'event: tick\nid: 2\ndata: two\ndata: lines\n\n')
+        self.assertEqual(events.next(), ': heartbeat\n\n')
+        for event in events:
+            if event != ': heartbeat\n\n':
+                break
+        self.assertEqual(event, 'data: three\n\n')
+
+        # closing the response, as the server does when the client
+        # goes away, stops the generator
+        response.close()
+        response.response.producer.join(1)
+        self.assertEqual(sys.modules['startup'].closed, [True])
+
+    def test_context_providers(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write(dedent('''
+            from keystone.render import context_provider
+            counts = []
+
+            @context_provider(refresh=0.05, name='count')
+            def counter():
+                counts.append(1)
+                return len(counts)
+
+            @context_provider
+            def flags():
+                return {'beta': True}
+            '''))
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('{{ count }} {{ flags.beta }}')
+
+        app = Keystone(self.app_dir)
+        try:
+            response = app.dispatch(Request(wsgi_environ('GET', '/')))
+            self.assertEqual(''.join(response.response), '1 True')
+
+            time.sleep(0.2)
+            response = app.dispatch(Request(wsgi_environ('GET', '/')))
+            count = int(''.join(response.response).split()[0])
+            self.assertTrue(count > 1, 'context provider was not refreshed')
+        finally:
+            app.close()
+
+        app.engine.providers.thread.join(1)
+        self.assertFalse(app.engine.providers.thread.isAlive(), 'close() did not stop the refresher')
+
+        from keystone.render import context_provider
+        self.assertRaises(RuntimeError, context_provider, lambda: 1)
+
+    def test_after_fork(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write(dedent('''
+            from keystone.render import context_provider
+            counts = []
+
+            @context_provider(refresh=0.05, name='count')
+            def counter():
+                counts.append(1)
+                return len(counts)
+            '''))
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('x = defer(len, "ab")\n----\n{{ count }} {{ x }}')
+
+        app = Keystone(self.app_dir)
+        try:
+            # start the defer() threads before forking
+            response = app.dispatch(Request(wsgi_environ('GET', '/')))
+            self.assertEqual(''.join(response.response), '1 2')
+
+            pid = os.fork()
+            if not pid:
+                # threads started before the fork don't run in the child
+                status = 1
+                try:
+                    app.after_fork()
+                    time.sleep(0.2)
+                    response = app.dispatch(Request(wsgi_environ('GET', '/')))
+                    count, x = ''.join(response.response).split()
+                    if int(count) > 1 and x == '2':
+                        status = 0
+                finally:
+                    os._exit(status)
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+        finally:
+            app.close()
+
+    def test_after_response(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write(dedent('''
+            import time
+            log = []
+            def record(path, delay=0):
+                time.sleep(delay)
+                log.append(path)
+            '''))
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('from startup import record\nafter_response(record, request.path, delay=0.1)\n----\nhi')
+        with file(os.path.join(self.app_dir, 'cached.ks'), 'w') as fp:
+            fp.write('__cache__ = 60\nfrom startup import record\nafter_response(record, request.path)\n----\nhi')
+
+        app = Keystone(self.app_dir)
+        log = sys.modules['startup'].log
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(''.join(response.response), 'hi')
+        self.assertEqual(log, [], 'task ran before the response was sent')
+        response.close()
+
+        app.dispatch(Request(wsgi_environ('GET', '/cached'))).close()
+
+        # closing the application waits for queued tasks
+        app.close()
+        self.assertEqual(sorted(log), ['/', '/cached'])
+
+        # a full queue drops tasks when asked to
+        from keystone.pool import ThreadPool
+        pool = ThreadPool(1, max_queue=1, full='drop')
+        app = Keystone(self.app_dir, after_response_pool=pool)
+        log = sys.modules['startup'].log
+        for i in range(4):
+            app.dispatch(Request(wsgi_environ('GET', '/'))).close()
+        pool.close(wait=True)
+        self.assertTrue(pool.dropped >= 1, 'no tasks were dropped')
+        self.assertEqual(len(log) + pool.dropped, 4)
+        app.close()
+
     def test_cookies(self):
         changer = util.MtimeChanger()
         index = os.path.join(self.app_dir, 'index.ks')
@@ -386,3 +715,277 @@ class KeystoneTest(unittest.TestCase):
         self.assertTrue(isinstance(response, BaseResponse))
         self.assertEqual(output, 'silly')
 
+
+    def test_page_cache(self):
+        changer = util.MtimeChanger()
+        index = os.path.join(self.app_dir, 'index.ks')
+        with changer.change_times(file(index, 'w')) as fp:
+            fp.write('__cache__ = 60\nimport random\nvalue = random.random()\n----\n{{value}}')
+
+        app = Keystone(self.app_dir)
+        first = app.dispatch(Request(wsgi_environ('GET', '/')))
+        second = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data, second.data, 'cached page was re-rendered')
+
+        other = app.dispatch(Request(wsgi_environ('GET', '/?page=2')))
+        self.assertNotEqual(first.data, other.data, 'query string was not part of the cache key')
+
+        # POST requests are never served from the cache
+        posted = app.dispatch(Request(wsgi_environ('POST', '/')))
+        self.assertNotEqual(first.data, posted.data, 'POST was served from the cache')
+
+        # changing the template discards its cached pages
+        with changer.change_times(file(index, 'w')) as fp:
+            fp.write('__cache__ = 60\n----\nchanged')
+
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.data, 'changed')
+
+    def test_page_cache_dependencies(self):
+        changer = util.MtimeChanger()
+        base = os.path.join(self.app_dir, 'base.html')
+        with changer.change_times(file(base, 'w')) as fp:
+            fp.write('<p>{% block content %}{% endblock %}</p>')
+        with changer.change_times(file(os.path.join(self.app_dir, 'index.ks'), 'w')) as fp:
+            fp.write('__cache__ = 60\n----\n{% extends "base.html" %}{% block content %}hi{% endblock %}')
+
+        app = Keystone(self.app_dir)
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(''.join(response.response), '<p>hi</p>')
+
+        # changing the layout invalidates the pages which extend it
+        with changer.change_times(file(base, 'w')) as fp:
+            fp.write('<div>{% block content %}{% endblock %}</div>')
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(''.join(response.response), '<div>hi</div>')
+
+    def test_template_errors(self):
+        with file(os.path.join(self.app_dir, 'filter.ks'), 'w') as fp:
+            fp.write("{{ 'hi'|nosuch }}")
+        with file(os.path.join(self.app_dir, 'syntax.ks'), 'w') as fp:
+            fp.write("{% if %}")
+
+        app = Keystone(self.app_dir)
+        client = Client(app, BaseResponse)
+        for path in ('/filter', '/syntax', '/filter'):
+            self.assertEqual(client.get(path).status_code, 500)
+
+    def test_render_once(self):
+        changer = util.MtimeChanger()
+        base = os.path.join(self.app_dir, 'base.html')
+        with changer.change_times(file(base, 'w')) as fp:
+            fp.write('<title>{% block title %}{% endblock %}</title>{% block body %}{% endblock %}')
+        with changer.change_times(file(os.path.join(self.app_dir, 'about.ks'), 'w')) as fp:
+            fp.write('{% extends "base.html" %}{% block title %}About{% endblock %}'
+                     '{% block body %}{{ self.title() }}{% for i in range(2) %}{{ i }}{% endfor %}{% endblock %}')
+        with file(os.path.join(self.app_dir, 'path.ks'), 'w') as fp:
+            fp.write('{{ request.path }}')
+
+        app = Keystone(self.app_dir)
+        renders = []
+        render = app.engine.render
+        def counting_render(template, viewlocals):
+            renders.append(template.name)
+            return render(template, viewlocals)
+        app.engine.render = counting_render
+
+        self.assertTrue(app.engine.is_static(app.engine.get_template('about.ks').name))
+        for i in range(2):
+            response = app.dispatch(Request(wsgi_environ('GET', '/about')))
+            self.assertEqual(''.join(response.response), '<title>About</title>About01')
+            self.assertEqual(response.content_length, 27)
+            self.assertTrue('ETag' in response.headers)
+        self.assertEqual(renders, ['about.ks'], 'static template was rendered more than once')
+
+        # pages which use request variables are rendered every time
+        for i in range(2):
+            response = app.dispatch(Request(wsgi_environ('GET', '/path')))
+            self.assertEqual(''.join(response.response), '/path')
+        self.assertEqual(renders.count('path.ks'), 2)
+
+        # a new version of the layout is rendered again
+        with changer.change_times(file(base, 'w')) as fp:
+            fp.write('<h1>{% block title %}{% endblock %}</h1>')
+        response = app.dispatch(Request(wsgi_environ('GET', '/about')))
+        self.assertEqual(''.join(response.response), '<h1>About</h1>')
+
+        app = Keystone(self.app_dir, render_once=False)
+        self.assertTrue('ETag' not in app.dispatch(Request(wsgi_environ('GET', '/about'))).headers)
+
+    def test_stale_page_cache(self):
+        changer = util.MtimeChanger()
+        index = os.path.join(self.app_dir, 'index.ks')
+        with changer.change_times(file(index, 'w')) as fp:
+            fp.write('__cache__ = 60\nimport os\nif os.path.exists(app_dir + "/fail"): raise Exception\nvalue = "ok"\n----\n{{value}}')
+
+        app = Keystone(self.app_dir, stale_while_revalidate=30, stale_if_error=300)
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.data, 'ok')
+
+        # make rendering fail from here on
+        file(os.path.join(self.app_dir, 'fail'), 'w').close()
+        key = app.cache.key(Request(wsgi_environ('GET', '/')))
+        page = app.cache.pages[key]
+
+        # within stale_while_revalidate, the stale page is served and
+        # a failed background render leaves it in place
+        page.created -= 70
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'ok')
+        while app.cache.refreshing:
+            time.sleep(0.01)
+        self.assertTrue(app.cache.pages[key] is page, 'failed revalidation replaced the stale page')
+
+        # past that, but within stale_if_error, errors serve the stale page
+        page.created -= 100
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'ok')
+
+        # and past stale_if_error the error is returned
+        page.created -= 300
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.status_code, 500)
+
+    def test_coalesced_requests(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write('renders = []\n')
+
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('__coalesce__ = True\nimport startup, time\nstartup.renders.append(1)\n')
+            fp.write('time.sleep(0.2)\ncount = len(startup.renders)\n----\n{{count}}')
+
+        app = Keystone(self.app_dir)
+        responses = []
+        def request():
+            responses.append(app.dispatch(Request(wsgi_environ('GET', '/'))))
+
+        threads = [threading.Thread(target=request) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(sys.modules['startup'].renders), 1, 'concurrent requests were not coalesced')
+        self.assertEqual([r.data for r in responses], ['1'] * 10)
+
+        # once the first render completes, later requests render again
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertEqual(response.data, '2')
+
+    def test_coalesced_cookies(self):
+        with file(os.path.join(self.app_dir, 'startup.py'), 'w') as fp:
+            fp.write('renders = []\n')
+
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('__coalesce__ = True\nimport startup, time\nstartup.renders.append(1)\n')
+            fp.write('set_cookie("session", str(len(startup.renders)))\ntime.sleep(0.2)\n----\n')
+
+        app = Keystone(self.app_dir)
+        responses = []
+        def request():
+            responses.append(app.dispatch(Request(wsgi_environ('GET', '/'))))
+
+        threads = [threading.Thread(target=request) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # responses which set cookies are not shared
+        self.assertEqual(len(sys.modules['startup'].renders), 3)
+        cookies = set(r.headers['Set-Cookie'] for r in responses)
+        self.assertEqual(len(cookies), 3, 'coalesced requests shared a cookie')
+
+    def test_mirror_dir(self):
+        changer = util.MtimeChanger()
+        mirror_dir = os.path.join(self.app_dir, '_mirror')
+        os.makedirs(os.path.join(self.app_dir, 'sub'))
+        page = os.path.join(self.app_dir, 'sub', 'page.ks')
+        with changer.change_times(file(page, 'w')) as fp:
+            fp.write('__cache__ = 60\n----\n<p>mirrored</p>')
+        with file(os.path.join(self.app_dir, 'other.ks'), 'w') as fp:
+            fp.write('<p>not cached</p>')
+
+        app = Keystone(self.app_dir, mirror_dir=mirror_dir)
+        try:
+            mirrored = os.path.join(mirror_dir, 'sub', 'page', 'index.html')
+
+            app.dispatch(Request(wsgi_environ('GET', '/sub/page?q=1')))
+            self.assertFalse(os.path.exists(mirrored), 'page with a query string was mirrored')
+
+            app.dispatch(Request(wsgi_environ('GET', '/other')))
+            self.assertFalse(os.path.exists(os.path.join(mirror_dir, 'other', 'index.html')),
+                             'uncacheable page was mirrored')
+
+            app.dispatch(Request(wsgi_environ('GET', '/sub/page')))
+            self.assertEqual(file(mirrored).read(), '<p>mirrored</p>')
+            self.assertEqual(gzip.open(mirrored + '.gz').read(), '<p>mirrored</p>')
+
+            # editing the template removes the mirrored files
+            with changer.change_times(file(page, 'w')) as fp:
+                fp.write('__cache__ = 60\n----\n<p>changed</p>')
+            app.mirror.sweep()
+            self.assertFalse(os.path.exists(mirrored), 'mirrored page outlived its template')
+            self.assertFalse(os.path.exists(mirrored + '.gz'), 'mirrored page outlived its template')
+
+            # as does its TTL passing
+            app.dispatch(Request(wsgi_environ('GET', '/sub/page')))
+            self.assertTrue(os.path.exists(mirrored))
+            app.mirror.files[mirrored] = app.mirror.files[mirrored][:1] + (time.time() - 1, )
+            app.mirror.sweep()
+            self.assertFalse(os.path.exists(mirrored), 'mirrored page outlived its TTL')
+        finally:
+            app.close()
+
+        self.assertFalse(os.path.exists(mirrored + '.gz'), 'close() did not remove mirrored pages')
+
+    def test_auto_etag(self):
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('name = "world"\n----\nhello, {{name}}')
+        with file(os.path.join(self.app_dir, 'cached.ks'), 'w') as fp:
+            fp.write('__cache__ = 60\n----\ncached')
+
+        app = Keystone(self.app_dir)
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        self.assertTrue('ETag' not in response.headers, 'ETag was added without auto_etag')
+
+        app = Keystone(self.app_dir, auto_etag=True)
+        for path in ('/', '/cached'):
+            response = app.dispatch(Request(wsgi_environ('GET', path)))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('ETag' in response.headers, 'no ETag on %s' % path)
+            etag = response.headers['ETag']
+            self.assertFalse(etag.startswith('w/'), 'ETag on %s was weak' % path)
+
+            response = app.dispatch(Request(wsgi_environ('GET', path, headers={'If-None-Match': etag})))
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, '')
+            self.assertEqual(response.headers['ETag'], etag)
+
+            response = app.dispatch(Request(wsgi_environ('GET', path, headers={'If-None-Match': '"other"'})))
+            self.assertEqual(response.status_code, 200)
+
+    def test_not_modified_headers(self):
+        with file(os.path.join(self.app_dir, 'index.ks'), 'w') as fp:
+            fp.write('headers["Cache-Control"] = "max-age=60"\n'
+                     'headers["Vary"] = "Cookie"\n'
+                     'headers["X-Other"] = "yes"\n'
+                     'set_cookie("session", "abc")\n'
+                     '----\nhello')
+
+        app = Keystone(self.app_dir, auto_etag=True)
+        response = app.dispatch(Request(wsgi_environ('GET', '/')))
+        etag = response.headers['ETag']
+
+        # headers about caching the page are sent with the 304
+        response = app.dispatch(Request(wsgi_environ('GET', '/', headers={'If-None-Match': etag})))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(response.headers['Vary'], 'Cookie')
+        self.assertTrue(response.headers['Set-Cookie'].startswith('session=abc'))
+        self.assertTrue('X-Other' not in response.headers)
+        self.assertTrue('Content-Type' not in response.headers)
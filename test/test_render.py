@@ -29,16 +29,26 @@ import os
 import os.path
 import shutil
 import re
+import string
+import threading
+import time
 import unittest
 from inspect import iscode, isfunction, getargspec
 from StringIO import StringIO
 
+import jinja2
+
 import util
 
 from keystone.render import Template
 from keystone.render import InvalidTemplate
 from keystone.render import TemplateNotFound
 from keystone.render import RenderEngine
+from keystone.render import TemplateCache
+from keystone.render import coalesce
+from keystone.render import FLUSH
+from keystone.render import minify
+from keystone.render import template_filter
 
 
 def dedent(string, joiner='\n'):
@@ -180,6 +190,97 @@ class ParserTest(unittest.TestCase):
         returned_locals = template.viewfunc({'injected': 'anything'})
         self.assertEquals({'x': 1}, returned_locals)
 
+    def test_viewfunc_semantics(self):
+        engine = RenderEngine(MockApp())
+
+        # view variables shadow builtins, and nested scopes see them
+        templatefp = template_fileobj("""
+        import string
+        doubled = [i * 2 for i in ids]
+        ident = id
+        total = sum(map(lambda i: i + offset, ids))
+        upper = string.upper(name)
+        try:
+            missing
+        except NameError:
+            failed = True
+        ----
+        """)
+        template = engine.parse(templatefp)
+        returned_locals = template.viewfunc({'ids': [1, 2], 'offset': 10, 'name': 'x', 'id': 'y'})
+        self.assertEquals([2, 4], returned_locals['doubled'])
+        self.assertEquals(23, returned_locals['total'])
+        self.assertEquals('X', returned_locals['upper'])
+        self.assertEquals('y', returned_locals['ident'])
+        self.assertTrue(returned_locals['string'] is string, 'imported module is not a view variable')
+        self.assertTrue(returned_locals['failed'], 'undefined name did not raise NameError')
+        self.assertTrue('missing' not in returned_locals)
+
+        # view code which must run at module level still works
+        templatefp = template_fileobj("""
+        from os.path import *
+        joined = join('a', 'b')
+        ----
+        """)
+        template = engine.parse(templatefp)
+        self.assertEquals('a/b', template.viewfunc({})['joined'])
+
+        templatefp = template_fileobj("""
+        import os
+        from os.path import join
+        ----
+        """)
+        template = engine.parse(templatefp)
+        returned_locals = template.viewfunc({})
+        self.assertTrue(returned_locals['os'] is os)
+        self.assertTrue(returned_locals['join'] is os.path.join)
+
+        # as does view code which reads its namespace dynamically
+        templatefp = template_fileobj("""
+        evaluated = eval('name')
+        found = locals().get('name')
+        formatted = '%(name)s' % locals()
+        listed = 'name' in vars()
+        ----
+        """)
+        template = engine.parse(templatefp)
+        returned_locals = template.viewfunc({'name': 'x'})
+        self.assertEquals('x', returned_locals['evaluated'])
+        self.assertEquals('x', returned_locals['found'])
+        self.assertEquals('x', returned_locals['formatted'])
+        self.assertTrue(returned_locals['listed'])
+
+        # builtins assigned in a branch that doesn't run are not view
+        # variables
+        templatefp = template_fileobj("""
+        if name:
+            id = 5
+        ----
+        """)
+        template = engine.parse(templatefp)
+        self.assertEquals(5, template.viewfunc({'name': 'x'})['id'])
+        self.assertTrue('id' not in template.viewfunc({'name': ''}))
+
+    def test_directives(self):
+        templatefp = template_fileobj("""
+        __cache__ = 60
+        x = 1
+        ----
+        <strong>this is HTML</strong>
+        """)
+
+        engine = RenderEngine(MockApp())
+        template = engine.parse(templatefp)
+        self.assertEquals({'cache': 60}, template.options)
+        self.assertEquals({'cache': 60}, template.copy().options)
+
+        templatefp = template_fileobj("""
+        __cache__ = some_function()
+        ----
+        <strong>this is HTML</strong>
+        """)
+        self.assertRaises(InvalidTemplate, engine.parse, templatefp)
+
 
 class CompilerTest(unittest.TestCase):
     """
@@ -312,6 +413,295 @@ class TestRenderEngine(unittest.TestCase):
 
         self.assertTrue(template1 is not template2, 'template should not be the same after file changes')
 
+    def test_check_interval(self):
+        engine = RenderEngine(MockApp(self.app_dir), check_interval=60)
+        filename = os.path.join(self.app_dir, 'tmpl.ks')
+        changer = util.MtimeChanger()
+
+        with changer.change_times(file(filename, 'w')) as fp:
+            fp.write('{{x}}')
+        template1 = engine.get_template('tmpl.ks')
+
+        with changer.change_times(file(filename, 'w')) as fp:
+            fp.write('<p>{{x}}</p>')
+        self.assertTrue(template1 is engine.get_template('tmpl.ks'), 'file was checked within the interval')
+
+        # once the interval has passed, the change is seen
+        engine.checked['tmpl.ks'] -= 60
+        template2 = engine.get_template('tmpl.ks')
+        self.assertTrue(template1 is not template2, 'file was not checked after the interval')
+
+        os.remove(filename)
+        self.assertTrue(template2 is engine.get_template('tmpl.ks'))
+        engine.checked['tmpl.ks'] -= 60
+        self.assertRaises(TemplateNotFound, engine.get_template, 'tmpl.ks')
+
+    def test_concurrent_refresh(self):
+        class CountingEngine(RenderEngine):
+            parses = 0
+            def parse(self, fileobj):
+                CountingEngine.parses += 1
+                time.sleep(0.05)
+                return RenderEngine.parse(self, fileobj)
+
+        engine = CountingEngine(MockApp(self.app_dir))
+        filename = os.path.join(self.app_dir, 'tmpl.ks')
+        changer = util.MtimeChanger()
+
+        def hammer():
+            errors, seen = [], set()
+            start = threading.Event()
+            def run():
+                start.wait()
+                try:
+                    for i in range(20):
+                        template = engine.get_template('tmpl.ks')
+                        seen.add(template)
+                        ''.join(engine.render(template.copy(), {}))
+                except Exception, e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=run) for i in range(32)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEquals([], errors)
+            return seen
+
+        for version in range(3):
+            with changer.change_times(file(filename, 'w')) as fp:
+                fp.write('x = %d\n----\n{{x}}' % version)
+
+            seen = hammer()
+            self.assertEquals(version + 1, CountingEngine.parses, 'template was parsed more than once per change')
+            self.assertEquals(1, len(seen), 'threads saw different snapshots of an unchanged template')
+
+    def test_warm_up(self):
+        os.makedirs(os.path.join(self.app_dir, 'sub'))
+        for name in ('a.ks', 'b.ks', os.path.join('sub', 'c.ks')):
+            with file(os.path.join(self.app_dir, name), 'w') as fp:
+                fp.write('x = %r\n----\n{{x}}' % name)
+        with file(os.path.join(self.app_dir, 'broken.ks'), 'w') as fp:
+            fp.write('x = \n----\n{{x}}')
+
+        def no_compile(*args, **kwargs):
+            raise AssertionError('template was compiled after warm up')
+
+        for processes, pool_threshold in ((1, 50), (2, 1)):
+            engine = RenderEngine(MockApp(self.app_dir))
+            if processes > 1:
+                # templates should be compiled by the pool's processes
+                engine.jinja_env.compile = no_compile
+
+            with util.WarningCatcher(UserWarning) as wc:
+                engine.warm_up(processes, pool_threshold)
+                if processes == 1:
+                    # (the second time round, python suppresses it)
+                    self.assertTrue(wc.has_warning(UserWarning), 'broken template did not warn')
+
+            self.assertEquals(['a.ks', 'b.ks', os.path.join('sub', 'c.ks')], sorted(engine.templates))
+            engine.jinja_env.compile = no_compile
+            for name in engine.templates:
+                output = ''.join(engine.render(engine.get_template(name), {}))
+                self.assertEquals(name, output)
+
+    def test_dependencies(self):
+        class CountingEngine(RenderEngine):
+            def refresh_if_needed(self, name):
+                self.checks.append(name)
+                return RenderEngine.refresh_if_needed(self, name)
+
+        changer = util.MtimeChanger()
+        files = {
+            'base.html': '<html>{% block body %}{% endblock %}</html>',
+            'layout.html': '{% extends "base.html" %}{% block body %}{% include "nav.html" %}'
+                           '{% block content %}{% endblock %}{% endblock %}',
+            'nav.html': '<nav></nav>',
+            'page.ks': 'x = 1\n----\n{% extends "layout.html" %}{% block content %}{{x}}{% endblock %}',
+        }
+        for name, body in files.iteritems():
+            with changer.change_times(file(os.path.join(self.app_dir, name), 'w')) as fp:
+                fp.write(body)
+
+        engine = CountingEngine(MockApp(self.app_dir))
+        engine.checks = []
+        template = engine.get_template('page.ks')
+        self.assertEquals(('layout.html', ), template.dependencies)
+        self.assertFalse(template.dynamic)
+        self.assertEquals(set(files), set(t.name for t in engine.closure('page.ks')))
+
+        for i in range(2):
+            engine.checks = []
+            output = ''.join(engine.render(engine.get_template('page.ks'), {}))
+            self.assertEquals('<html><nav></nav>1</html>', output)
+            self.assertEquals(sorted(files), sorted(engine.checks), 'templates were checked more than once')
+
+        # a change to the base layout is seen by the page
+        version = engine.version('page.ks')
+        with changer.change_times(file(os.path.join(self.app_dir, 'base.html'), 'w')) as fp:
+            fp.write('<body>{% block body %}{% endblock %}</body>')
+        output = ''.join(engine.render(engine.get_template('page.ks'), {}))
+        self.assertEquals('<body><nav></nav>1</body>', output)
+        self.assertTrue(engine.version('page.ks') > version, 'page version did not change with its layout')
+        self.assertEquals(engine.version('nav.html'), engine.templates['nav.html'].mtime)
+
+    def test_template_cache(self):
+        for name in ('a.ks', 'b.ks', 'c.ks', 'd.ks'):
+            with file(os.path.join(self.app_dir, name), 'w') as fp:
+                fp.write('x = %r\n----\n{{x}}' % name)
+
+        cache = TemplateCache(max_entries=2, pinned=['a.ks'])
+        engine = RenderEngine(MockApp(self.app_dir), template_cache=cache)
+        for name in ('a.ks', 'b.ks', 'a.ks', 'c.ks', 'd.ks'):
+            self.assertEquals(name, ''.join(engine.render(engine.get_template(name), {})))
+
+        self.assertTrue(len(cache) <= 2, 'cache holds too many templates')
+        self.assertTrue('a.ks' in cache, 'pinned template was evicted')
+        self.assertTrue('d.ks' in cache, 'most recently used template was evicted')
+
+        stats = cache.stats()
+        self.assertTrue(stats['evictions'] >= 2)
+        self.assertEquals(stats['compiled'], 2, 'compiled templates are not kept with their entries')
+        self.assertTrue(stats['bytes'] > 0)
+
+        hits = stats['compiled_hits']
+        ''.join(engine.render(engine.get_template('d.ks'), {}))
+        self.assertTrue(cache.stats()['compiled_hits'] > hits, 'compiled template was not reused')
+
+        # a byte limit evicts compiled templates along with their entries
+        cache = TemplateCache(max_entries=None, max_bytes=100)
+        engine = RenderEngine(MockApp(self.app_dir), template_cache=cache)
+        parses = []
+        parse = engine.parse
+        engine.parse = lambda *args: parses.append(args) or parse(*args)
+        for name in ('b.ks', 'c.ks'):
+            self.assertEquals(name, ''.join(engine.render(engine.get_template(name), {})))
+        self.assertEquals(['c.ks'], list(cache))
+        self.assertEquals(cache.footprint()[0][1], cache.stats()['bytes'])
+
+        # but a template larger than the limit is kept, and not parsed
+        # again on every request
+        for i in range(5):
+            self.assertEquals('c.ks', ''.join(engine.render(engine.get_template('c.ks'), {})))
+        self.assertEquals(2, len(parses))
+        self.assertTrue(cache.stats()['bytes'] > 100)
+
+        # nor is a template churned out by its neighbour at 1 entry
+        cache = TemplateCache(max_entries=1)
+        engine = RenderEngine(MockApp(self.app_dir), template_cache=cache)
+        parses = []
+        parse = engine.parse
+        engine.parse = lambda *args: parses.append(args) or parse(*args)
+        for name in ('b.ks', 'b.ks', 'b.ks', 'c.ks', 'c.ks', 'c.ks'):
+            self.assertEquals(name, ''.join(engine.render(engine.get_template(name), {})))
+        self.assertEquals(2, len(parses))
+        self.assertEquals(['c.ks'], list(cache))
+
+    def test_compact_templates(self):
+        with file(os.path.join(self.app_dir, 'tmpl.ks'), 'w') as fp:
+            fp.write('import os\nx = 1\n----\n<p>{{x}}</p>')
+
+        engine = RenderEngine(MockApp(self.app_dir))
+        template = engine.get_template('tmpl.ks')
+        self.assertFalse(hasattr(template, '__dict__'), 'Template has a __dict__')
+        self.assertEquals('<p>{{x}}</p>', template._body)
+
+        # once compiled, the body is released, and read again if needed
+        self.assertEquals('<p>1</p>', ''.join(engine.render(template, {})))
+        self.assertTrue(template._body is None, 'body was not released after compiling')
+        self.assertEquals('<p>{{x}}</p>', template.body)
+
+        (name, size), = engine.templates.footprint()
+        self.assertEquals('tmpl.ks', name)
+        self.assertEquals(size, engine.templates.stats()['bytes'])
+
+        # view code importing the same names shares its globals
+        code1, globals1 = engine.compile('import os\nx = 1\n', 'a.ks')
+        code2, globals2 = engine.compile('import os\ny = 2\n', 'b.ks')
+        code3, globals3 = engine.compile('import os\nglobal z\nz = 3\n', 'c.ks')
+        self.assertTrue(globals1 is globals2, 'view globals were not shared')
+        self.assertTrue(globals1 is not globals3, 'view globals were shared with code that assigns them')
+
+    def test_minify(self):
+        source = dedent('''
+            <html>
+              <!-- navigation -->
+              <!--[if IE]><p>old</p><![endif]-->
+              <p class="a">
+                {{ "a    b" }}   {% if x %}  yes  {% endif %}
+              </p>
+              <pre>
+                keep   this
+              </pre>
+              <script>var  x = 1;</script>
+              {% raw %}  {{  raw  }}  {% endraw %}
+            </html>
+            ''')
+        self.assertEquals(dedent('''
+            <html>
+
+            <!--[if IE]><p>old</p><![endif]-->
+            <p class="a">
+            {{ "a    b" }} {% if x %} yes {% endif %}
+            </p>
+            <pre>
+                keep   this
+              </pre>
+            <script>var  x = 1;</script>
+            {% raw %}  {{  raw  }}  {% endraw %}
+            </html>
+            '''), minify(source))
+
+        with file(os.path.join(self.app_dir, 'tmpl.ks'), 'w') as fp:
+            fp.write('x = 1\n----\n<ul>\n  {% for i in [1, 2] %}\n    <li>  {{i}}</li>\n  {% endfor %}\n</ul>\n')
+
+        engine = RenderEngine(MockApp(self.app_dir), minify=True)
+        output = ''.join(engine.render(engine.get_template('tmpl.ks'), {}))
+        self.assertEquals('<ul>\n<li> 1</li>\n<li> 2</li>\n</ul>', output)
+
+    def test_memoized_filters(self):
+        from jinja2 import Markup
+        engine = RenderEngine(MockApp(self.app_dir))
+        calls = []
+        with engine.starting():
+            @template_filter(cache=2, ttl=60)
+            def shout(value, suffix='!'):
+                calls.append(value)
+                return value.upper() + suffix
+
+            @template_filter(cache=10, ttl=0.05)
+            def stamp(value):
+                calls.append(value)
+                return time.time()
+
+        with file(os.path.join(self.app_dir, 'tmpl.ks'), 'w') as fp:
+            fp.write('{{ x|shout }}{{ x|shout }}{{ x|shout("?") }}')
+        for i in range(2):
+            output = ''.join(engine.render(engine.get_template('tmpl.ks'), {'x': 'hi'}))
+            self.assertEquals('HI!HI!HI?', output)
+        self.assertEquals(['hi', 'hi'], calls)
+        self.assertEquals((4, 2, 2, 2), tuple(shout.cache_info()))
+
+        # values which compare equal but have different types are kept apart
+        self.assertTrue(isinstance(shout(Markup('hi')), Markup))
+        # unhashable arguments aren't cached
+        calls[:] = []
+        self.assertEquals('A!', shout('a', suffix=bytearray('!')))
+        self.assertEquals('A!', shout('a', suffix=bytearray('!')))
+        self.assertEquals(['a', 'a'], calls)
+
+        # results expire after their ttl
+        first = stamp('x')
+        self.assertEquals(first, stamp('x'))
+        time.sleep(0.06)
+        self.assertNotEquals(first, stamp('x'))
+
+        shout.cache_clear()
+        self.assertEquals(0, shout.cache_info().currsize)
+
     def test_full_render(self):
         engine = RenderEngine(MockApp(self.app_dir))
         filename = os.path.join(self.app_dir, 'tmpl.ks')
@@ -375,3 +765,32 @@ class TestRenderEngine(unittest.TestCase):
 
         self.assertEquals('\n<strong>this is the child</strong>\n\n\n<strong>this is the new base</strong>', output)
 
+
+
+    def test_coalesce(self):
+        chunks = [u'a', u'b', u'c\u00e9', u'd', u'e']
+        self.assertEquals(['abc\xc3\xa9', 'de'], list(coalesce(chunks, 4)))
+        self.assertEquals(['abc\xc3\xa9de'], list(coalesce(chunks, 100)))
+
+        # flushes yield what has been buffered, then an empty string
+        chunks = [u'a', u'b' + FLUSH + u'c', u'd', FLUSH, u'e']
+        self.assertEquals(['ab', '', 'cd', '', 'e'], list(coalesce(chunks, 100)))
+
+    def test_flush_tag(self):
+        with file(os.path.join(self.app_dir, 'tmpl.ks'), 'w') as fp:
+            fp.write('<head></head>{% flush %}<body></body>')
+
+        engine = RenderEngine(MockApp(self.app_dir))
+        t = engine.get_template('tmpl.ks')
+        output = list(coalesce(engine.render(t, {}), 100))
+
+        self.assertEquals(['<head></head>', '', '<body></body>'], output)
+
+        for source in ('{% filter upper %}a{% flush %}b{% endfilter %}',
+                       '{% macro m() %}a{% flush %}b{% endmacro %}',
+                       '{% call m() %}{% if 1 %}{% flush %}{% endif %}{% endcall %}'):
+            with file(os.path.join(self.app_dir, 'tmpl.ks'), 'w') as fp:
+                fp.write(source)
+            engine = RenderEngine(MockApp(self.app_dir))
+            t = engine.get_template('tmpl.ks')
+            self.assertRaises(jinja2.TemplateSyntaxError, engine.render, t, {})
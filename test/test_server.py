@@ -0,0 +1,156 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import with_statement
+
+import httplib
+import os
+import signal
+import threading
+import time
+import unittest
+
+from keystone.server import PreforkServer
+
+class App(object):
+
+    def __init__(self):
+        self.created = os.getpid()
+        self.forked = None
+
+    def after_fork(self):
+        self.forked = os.getpid()
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            time.sleep(0.5)
+        if environ['PATH_INFO'] == '/created':
+            body = '%d %s' % (self.created, self.forked)
+        else:
+            body = str(os.getpid())
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+class PreforkServerTest(unittest.TestCase):
+
+    preload = False
+
+    def setUp(self):
+        self.server = PreforkServer(App, host='127.0.0.1', port=0,
+                                    workers=2, threads=4, graceful_timeout=5,
+                                    preload=self.preload)
+        self.pid = os.fork()
+        if not self.pid:
+            status = 1
+            try:
+                self.server.serve_forever()
+                status = 0
+            finally:
+                os._exit(status)
+        self.server.listener.close()
+
+    def tearDown(self):
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.port, timeout=10)
+        for attempt in range(50):
+            try:
+                conn.connect()
+                return conn
+            except IOError:
+                time.sleep(0.1)
+        self.fail('server did not start')
+
+    def stop(self):
+        os.kill(self.pid, signal.SIGTERM)
+        pid, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        return status
+
+    def test_keepalive(self):
+        conn = self.connect()
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        self.assertEqual(200, response.status)
+        worker = response.read()
+        self.assertNotEqual(str(self.pid), worker)
+
+        # the same connection, and so the same worker, serves both
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        self.assertEqual(worker, response.read())
+        conn.close()
+
+        self.assertEqual(0, self.stop())
+
+    def test_preload(self):
+        conn = self.connect()
+        conn.request('GET', '/')
+        worker = conn.getresponse().read()
+        conn.request('GET', '/created')
+        created, forked = conn.getresponse().read().split()
+        conn.close()
+
+        if self.preload:
+            self.assertEqual(str(self.pid), created)
+            self.assertEqual(worker, forked)
+        else:
+            self.assertEqual(worker, created)
+            self.assertEqual('None', forked)
+        self.assertEqual(0, self.stop())
+
+    def test_graceful_shutdown(self):
+        conn = self.connect()
+        conn.request('GET', '/')
+        conn.getresponse().read()
+
+        responses = []
+        def slow():
+            conn.request('GET', '/slow')
+            response = conn.getresponse()
+            responses.append((response.status, response.read(),
+                              response.getheader('Connection')))
+        thread = threading.Thread(target=slow)
+        thread.start()
+        time.sleep(0.2)
+
+        self.assertEqual(0, self.stop())
+        thread.join()
+        self.assertEqual(200, responses[0][0])
+        self.assertEqual('close', responses[0][2])
+
+class PreloadServerTest(PreforkServerTest):
+
+    preload = True
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import with_statement
+from __future__ import with_statement
+
+import os
+import os.path
+import shutil
+import sys
+import unittest
+from werkzeug.wrappers import BaseResponse
+from werkzeug.test import Client
+
+from keystone.vhost import VirtualHosts
+
+class VirtualHostsTest(unittest.TestCase):
+
+    def setUp(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        self.root = os.path.join(here, 'app_dir')
+
+        shutil.rmtree(self.root, ignore_errors=True)
+        for site in ('alpha.example.com', 'beta.example.com', 'gamma.example.com'):
+            app_dir = os.path.join(self.root, site)
+            os.makedirs(app_dir)
+
+            # each site registers a filter with the same name
+            with file(os.path.join(app_dir, 'startup.py'), 'w') as fp:
+                fp.write('from keystone.render import template_filter\n')
+                fp.write('@template_filter\n')
+                fp.write('def site(value):\n')
+                fp.write('    return %r\n' % site)
+
+            with file(os.path.join(app_dir, 'index.ks'), 'w') as fp:
+                fp.write('{{ none|site }}')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        if 'startup' in sys.modules:
+            del sys.modules['startup']
+
+    def get(self, app, host):
+        return Client(app, BaseResponse).get('/', headers=[('Host', host)])
+
+    def test_dispatch_by_host(self):
+        app = VirtualHosts(root=self.root)
+
+        for site in ('alpha.example.com', 'beta.example.com', 'gamma.example.com'):
+            response = self.get(app, site)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, site)
+
+        # sites keep their own filters once others have loaded
+        self.assertEqual(self.get(app, 'ALPHA.example.com:8080').data, 'alpha.example.com')
+
+        self.assertEqual(self.get(app, 'unknown.example.com').status_code, 404)
+        self.assertEqual(self.get(app, '..').status_code, 404)
+
+    def test_explicit_hosts(self):
+        app = VirtualHosts(hosts={'www.example.com': os.path.join(self.root, 'beta.example.com')})
+        self.assertEqual(self.get(app, 'www.example.com').data, 'beta.example.com')
+        self.assertEqual(self.get(app, 'alpha.example.com').status_code, 404)
+
+    def test_mirror_dir(self):
+        for site in ('alpha.example.com', 'beta.example.com'):
+            with file(os.path.join(self.root, site, 'index.ks'), 'w') as fp:
+                fp.write('__cache__ = 60\n----\n{{ none|site }}')
+
+        mirror_root = os.path.join(self.root, '_mirror')
+        app = VirtualHosts(root=self.root, mirror_dir=mirror_root)
+        try:
+            for site in ('alpha.example.com', 'beta.example.com'):
+                self.assertEqual(self.get(app, site).data, site)
+            # each site mirrors into, and clears, its own directory
+            for site in ('alpha.example.com', 'beta.example.com'):
+                with file(os.path.join(mirror_root, site, 'index.html')) as fp:
+                    self.assertEqual(fp.read(), site)
+        finally:
+            app.close()
+
+    def test_shared_pools(self):
+        app = VirtualHosts(root=self.root)
+        alpha = app.get_app('alpha.example.com')
+        beta = app.get_app('beta.example.com')
+        self.assertTrue(alpha.pool is beta.pool)
+        self.assertTrue(alpha.after_pool is beta.after_pool, 'after-response pool was not shared')
+
+        app.close()
+        self.assertTrue(alpha.after_pool.closed, 'after-response pool was not closed')
+
+    def test_shared_filters(self):
+        with file(os.path.join(self.root, 'sharedfilters.py'), 'w') as fp:
+            fp.write('from keystone.render import template_filter\n')
+            fp.write('@template_filter\n')
+            fp.write('def shout(value):\n')
+            fp.write('    return value.upper()\n')
+        for site in ('alpha.example.com', 'beta.example.com'):
+            app_dir = os.path.join(self.root, site)
+            with file(os.path.join(app_dir, 'startup.py'), 'a') as fp:
+                fp.write('import sharedfilters\n')
+            with file(os.path.join(app_dir, 'index.ks'), 'w') as fp:
+                fp.write('{{ none|site|shout }}')
+
+        sys.path.insert(0, self.root)
+        try:
+            app = VirtualHosts(root=self.root)
+            # the module is only imported by the first site to load
+            self.assertEqual(self.get(app, 'alpha.example.com').data, 'ALPHA.EXAMPLE.COM')
+            self.assertEqual(self.get(app, 'beta.example.com').data, 'BETA.EXAMPLE.COM')
+        finally:
+            sys.path.remove(self.root)
+            sys.modules.pop('sharedfilters', None)
+
+    def test_offload(self):
+        for site in ('alpha.example.com', 'beta.example.com'):
+            app_dir = os.path.join(self.root, site)
+            with file(os.path.join(app_dir, 'startup.py'), 'a') as fp:
+                fp.write('def work():\n')
+                fp.write('    return %r\n' % site)
+            with file(os.path.join(app_dir, 'offload.ks'), 'w') as fp:
+                fp.write('from startup import work\nresult = offload(work)\n----\n{{ result }}')
+
+        app = VirtualHosts(root=self.root)
+        try:
+            client = Client(app, BaseResponse)
+            get = lambda host: client.get('/offload', headers=[('Host', host)]).data
+            # each site's workers run its own startup.py, whichever
+            # site was loaded last
+            self.assertEqual(get('alpha.example.com'), 'alpha.example.com')
+            self.assertEqual(get('beta.example.com'), 'beta.example.com')
+            self.assertEqual(get('alpha.example.com'), 'alpha.example.com')
+        finally:
+            app.close()
+
+    def test_eviction(self):
+        app = VirtualHosts(root=self.root, max_apps=2)
+        self.get(app, 'alpha.example.com')
+        self.get(app, 'beta.example.com')
+        app.apps['beta.example.com'][1] -= 10
+
+        self.get(app, 'gamma.example.com')
+        self.assertEqual(sorted(app.apps), ['alpha.example.com', 'gamma.example.com'],
+                         'least recently used site was not unloaded')
+
+        # idle sites are unloaded, and loaded again on demand
+        app = VirtualHosts(root=self.root, idle_timeout=60)
+        self.get(app, 'alpha.example.com')
+        self.get(app, 'beta.example.com')
+        app.apps['alpha.example.com'][1] -= 120
+        app.last_sweep -= 2
+        self.get(app, 'beta.example.com')
+        self.assertEqual(sorted(app.apps), ['beta.example.com'], 'idle site was not unloaded')
+
+        self.assertEqual(self.get(app, 'alpha.example.com').data, 'alpha.example.com')